@@ -1,5 +1,123 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
 from enum import Enum
-import copy
+import hashlib
+import inspect
+import json
+import math
+from multiprocessing import shared_memory
+import os
+import threading
+import time
+from statistics import NormalDist
+import numpy as np
+
+#scipy is optional, used by _norm_cdf() and _norm_ppf() when installed
+try:
+    from scipy.special import ndtr as _ndtr, ndtri as _ndtri
+except ImportError:
+    _ndtr = None
+    _ndtri = None
+
+#Active ProfileStats while inside profile(), otherwise None. A context
+#variable, so profiles opened in different threads do not see each other
+_stats = contextvars.ContextVar("MNSensitivity_stats", default=None)
+
+class ProfileStats:
+    """ Counts and total times of instrumented events, collected by
+    profile(). counts and times map event names to the number of calls and
+    the total seconds spent in them:
+
+        element_Z       - evaluations of the impedance of every element in a
+                          circuit (CompiledCircuit.Z(), the single frequency
+                          path of Z_out() and the generated ladder code)
+        compile_circuit - validating and packing a circuit list
+        Z_out           - ladder walks (CompiledCircuit.Z_out)
+        grad_Z_out      - ladder walks with derivatives
+        find_element    - element lookups by name
+        perturbation    - perturbed networks described (one per finite
+                          difference in sensitivity() and the spectra)
+        spectrum        - get_spectrum_*() calls
+    """
+
+    def __init__(self):
+
+        self.counts = {}
+        self.times = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        out = ""
+        for event in sorted(self.counts, key=lambda e: -self.times[e]):
+            out = out + f"\t{event:16s} {self.counts[event]:10d} calls {self.times[event]*1e3:12.3f} ms\n"
+        return out
+
+    def __repr__(self):
+        return self.__str__()
+
+    def add(self, event:str, dt:float=0):
+        """ Records one call of event taking dt seconds """
+
+        with self._lock:
+            self.counts[event] = self.counts.get(event, 0) + 1
+            self.times[event] = self.times.get(event, 0) + dt
+
+@contextmanager
+def profile():
+    """ Collects ProfileStats of the instrumented functions while inside the
+    with block. Instrumentation costs one context variable lookup per call
+    when no profile is active. Only the innermost active profile() collects
+    events, and only from its own thread and context (spectrum_threaded()
+    passes its caller's profile on to its workers).
+
+    eg.
+        with profile() as stats:
+            get_spectrum_pcnt(net, "L1 L", fs)
+        print(stats)
+    """
+
+    stats = ProfileStats()
+    token = _stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _stats.reset(token)
+
+class _LRUCache:
+    """ Thread safe least recently used cache of at most max_size entries,
+    shared by the module's internal caches.
+    """
+
+    def __init__(self, max_size:int):
+
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """ Returns the value stored for key, or default """
+
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        """ Stores value for key, evicting the least recently used entry if
+        the cache is full.
+        """
+
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
 
 class Network:
 
@@ -13,6 +131,8 @@ class Network:
 
     def __str__(self):
         out = f"Zs: {self.Z_s} ohms, Zl: {self.Z_l} ohms, freq: {self.freq} Hz, V_in: {self.V_in} V\n"
+        if isinstance(self.circ, CompiledCircuit):
+            return out + str(self.circ)
         for c in self.circ:
             a = c[0]
             b = c[1]
@@ -142,48 +262,75 @@ class Component:
 
             w += 2
 
-    def Z(self, freq:float):
+    def Z(self, freq, val:Values=None):
+        """ Calculates the impedance of the component. freq can be a float or
+        a numpy array of frequencies, in which case an array of impedances is
+        returned. If val is given, those values are used in place of the
+        component's own.
+        """
+
+        if val is None:
+            val = self.val
+
+        #Z_C is undefined at DC, so zero frequencies are evaluated separately
+        if isinstance(freq, np.ndarray):
+            freq = np.asarray(freq, dtype=float)
+            dc = (freq == 0)
+            if np.any(dc) and self.type in (Passive.C, Passive.L, Passive.R):
+                Z = np.empty(freq.shape, dtype=complex)
+                Z[dc] = self.Z_L(freq[dc], val) + val.R
+                Z[~dc] = self.Z(freq[~dc], val)
+                return Z
 
         if self.type == Passive.C:
 
-            if self.Z_C(freq) == None:
+            if self.Z_C(freq, val) is None:
                 print(f"WARNING: Capacitor {self.name} has 0 capacitance. Will behave like R or L.")
-                return self.Z_L(freq) + self.val.R
+                return self.Z_L(freq, val) + val.R
             else:
-                return self.val.R + self.Z_L(freq) + self.Z_C(freq)
+                return val.R + self.Z_L(freq, val) + self.Z_C(freq, val)
 
         elif self.type == Passive.L:
 
-            if self.Z_C(freq) == None:
-                return self.Z_L(freq) + self.val.R
+            if self.Z_C(freq, val) is None:
+                return self.Z_L(freq, val) + val.R
             else:
-                return self.pall(self.Z_L(freq) + self.val.R, self.Z_C(freq))
+                return self.pall(self.Z_L(freq, val) + val.R, self.Z_C(freq, val))
         elif self.type == Passive.R:
 
-            if self.Z_C(freq) == None:
-                return self.Z_L(freq) + self.val.R
+            if self.Z_C(freq, val) is None:
+                return self.Z_L(freq, val) + val.R
             else:
-                return self.Z_L(freq) + self.pall(self.val.R, self.Z_C(freq))
+                return self.Z_L(freq, val) + self.pall(val.R, self.Z_C(freq, val))
 
         else:
             print(f"ERROR: component {self.name} does not have a valid type {self.type}.")
             return None
 
-    def Z_C(self, f:float):
-        """ Calculates the impedance of a capacitor """
+    def Z_C(self, f, val:Values=None):
+        """ Calculates the impedance of a capacitor. Returns None if the
+        capacitance is zero or (for scalar f) the frequency is zero.
+        """
 
-        if self.val.C == 0 or f == 0:
+        if val is None:
+            val = self.val
+
+        if val.C == 0 or (not isinstance(f, np.ndarray) and f == 0):
             return None
 
-        return complex(0, -1)/(2*3.14159*f*self.val.C)
+        return complex(0, -1)/(2*3.14159*f*val.C)
 
-    def Z_L(self, f:float):
+    def Z_L(self, f, val:Values=None):
         """ Calculates the impedance of a capacitor """
-        return complex(0, 1)*(2*3.14159*f*self.val.L)
+
+        if val is None:
+            val = self.val
+
+        return complex(0, 1)*(2*3.14159*f*val.L)
 
     def pall(self, Z1:complex, Z2:complex):
         """ Calculates the impedance of two parallel elements """
-        return Z1*Z2/(Z1+Z2)
+        return pall(Z1, Z2)
 
     def str(self):
 
@@ -277,283 +424,4373 @@ def load_circuit(filename:str):
 
     return circuit
 
-def pall(Z1:complex, Z2:complex):
-    """ Calculates the impedance of two parallel elements """
-    return Z1*Z2/(Z1+Z2)
-
-def Z_out(circuit:list, freq:float, Zsource:complex):
-    """ Takes a circuit list (see load_circuit for format info) and frequency
-    and calculates the equivilient output impedance of the network.
+def save_circuit(circ, filename:str, comment:str=None):
+    """ Writes a circuit list or CompiledCircuit to a .mc file that
+    load_circuit() reads back. comment is written as a '#' header.
     """
 
-    Zout = Zsource
-    last_comp_name = None
+    cc = compile_circuit(circ)
+    if cc is None:
+        return None
 
-    for t in circuit:
+    with open(filename, "w") as file:
+        if comment is not None:
+            for line in comment.splitlines():
+                file.write(f"# {line}\n")
 
-        #Verifies that the circuit element is valid
-        try:
-            #Read component
-            comp = t[0]
-            comp.Z_L(1) #Will fail if not a component class
+        for i in range(len(cc)):
+            orientation = "SER" if cc.series[i] else "PAL"
+            kind = Passive(int(cc.types[i])).name
 
-            #Read orientation
-            orientation = t[1]
-            if orientation.upper() != "SER" and orientation.upper() != "PAL":
-                print(f"ERROR: Invalid orientation '{orientation}' in circuit. Element: '{comp.name}'")
-                return None
-        except Exception as e:
-            print(f"ERROR: Invalid circuit element. {str(e)}")
-            try:
-                print(f"\tError occured with component: {comp.name}")
-            except:
-                if last_comp_name == None:
-                    print("\tError occured with first component.")
-                else:
-                    print(f"\tError occured because missing component object. Last valid component object: {last_comp_name}")
+            #The element's own parameter first, then any parasitics
+            vals = {"R": float(cc.R[i]), "L": float(cc.L[i]), "C": float(cc.C[i])}
+            words = [orientation, cc.names[i], kind, kind, repr(vals.pop(kind))]
+            for p, v in vals.items():
+                if v != 0:
+                    words.extend([p, repr(v)])
+            file.write(" ".join(words) + "\n")
 
-            return None
+    return filename
 
-        #Save component name in case error occurs later and need to identify where
-        last_comp_name = comp.name
+class TabulatedImpedance:
+    """ An impedance tabulated against frequency, eg. a measured antenna
+    (see load_touchstone()). It can be used for Network.Z_s or Network.Z_l
+    wherever a constant impedance is accepted.
 
-        #If next element is parallel
-        if orientation == "PAL":
-            Zout = pall(Zout, comp.Z(freq))
-        elif orientation == "SER":
-            Zout = Zout + comp.Z(freq)
+    freqs - table frequencies (Hz), increasing
+    Z     - complex impedance at each table frequency
+    name  - description, eg. the file it was read from
 
-    return Zout
+    Between table points the real and imaginary parts are interpolated
+    linearly. Outside the table the end values are held.
+    """
 
-def P_load(Z_l:complex, Z_s:complex, Vin:float=1):
+    def __init__(self, freqs, Z, name:str=None):
 
-    return Vin**2 * Z_l.real/(Z_l+Z_s)**2
+        freqs = np.asarray(freqs, dtype=float)
+        Z = np.asarray(Z, dtype=complex)
+        order = np.argsort(freqs, kind='stable')
 
-def P_net(network):
+        self.freqs = freqs[order]
+        self.Z = Z[order]
+        self.name = name
 
-    return P_load(network.Z_l, Z_out(network.circ, network.freq, network.Z_s), network.V_in)
+        #Interpolation indices of recently used frequency arrays
+        self._index = []
 
-def tau_net(network):
-    Z_net = Z_out(network.circ, network.freq, network.Z_s)
-    return (4*network.Z_l*Z_net)/(network.Z_l**2 + 2*network.Z_l*Z_net + Z_net**2)
+    def __str__(self):
+        if len(self.freqs) == 0:
+            return f"TabulatedImpedance({self.name}, empty)"
+        return f"TabulatedImpedance({self.name}, {len(self.freqs)} points, {self.freqs[0]} to {self.freqs[-1]} Hz)"
 
-def sens_percent(network, param:str, val):
-    """
-    val: multiplier (2 -> +100%, 1 -> no change, etc)
-    """
+    def __repr__(self):
+        return self.__str__()
 
+    def __len__(self):
+        return len(self.freqs)
 
-    if type(val) != float and type(val) != float and type(val) != int:
-        print("ERROR: Value must be float, complex or int type.")
-        return None
+    def indices(self, freq):
+        """ Returns (i, t) such that the impedance at freq is
+        (1 - t)*Z[i] + t*Z[i+1]. A sweep re-evaluated at the same frequency
+        array (eg. nominal and perturbed networks) reuses the indices of the
+        last few arrays rather than searching the table again.
+        """
 
-    net = copy.deepcopy(network)
+        f = np.asarray(freq, dtype=float)
+        for f_old, i, t in self._index:
+            if f_old.shape == f.shape and np.array_equal(f_old, f):
+                return (i, t)
 
-    if param.upper() == "FREQ":
-        net.freq *= val
-        dv = net.freq*abs(val-1)
-    elif param.upper() == "Z_L":
-        net.Z_l *= val
-        dv = net.Z_l*abs(val-1)
-    elif param.upper() == "Z_S":
-        net.Z_s *= val
-        dv = net.Z_s*abs(val-1)
-    elif param.upper() == "VIN":
-        net.V_in *= val
-        dv = net.V_in*abs(val-1)
-    else:
-        words = param.split()
-        if len(words) < 2:
-            print("ERROR: Invalid parameter. Fewer than two words.")
-            return None
-        element_name = words[0]
-        val_name = words[1]
+        n = len(self.freqs)
+        if n < 2:
+            i = np.zeros(f.shape, dtype=np.intp)
+            t = np.zeros(f.shape)
+        else:
+            i = np.clip(np.searchsorted(self.freqs, f, side='right') - 1, 0, n - 2)
+            f0 = self.freqs[i]
+            f1 = self.freqs[i+1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = np.clip(np.where(f1 > f0, (f - f0)/(f1 - f0), 0), 0, 1)
+
+        #The list is replaced rather than changed, so threads sharing the
+        #table never see it part updated
+        self._index = [(f.copy(), i, t)] + self._index[:3]
 
-        element = None
-        for t in net.circ:
-            if t[0].name.upper() == element_name.upper():
-                element = t[0]
+        return (i, t)
 
-        if element == None:
-            print("ERROR: Element not found.")
+    def __call__(self, freq):
+        """ Returns the impedance at freq (a float or numpy array) """
+
+        if len(self.freqs) == 0:
+            print("ERROR: Impedance table is empty.")
             return None
 
-        if val_name.upper() == "C":
-            element.val.C *= val
-            dv = element.val.C*abs(val-1)
-        elif val_name.upper() == "L":
-            element.val.L *= val
-            dv = element.val.L*abs(val-1)
-        elif val_name.upper() == "R":
-            element.val.R *= val
-            dv = element.val.R*abs(val-1)
+        i, t = self.indices(freq)
+        if len(self.freqs) < 2:
+            Z = self.Z[i]
         else:
-            print(f"ERROR: Invalid element parameter '{val_name}'.")
+            Z = (1 - t)*self.Z[i] + t*self.Z[i+1]
+
+        return Z if np.ndim(freq) > 0 else complex(Z)
+
+    def slope(self, freq):
+        """ Returns dZ/dfreq at freq (a float or numpy array), the slope of
+        the interpolating segment. At a table frequency the segment above it
+        is used, and outside the table, where the end values are held, the
+        slope is 0.
+        """
+
+        if len(self.freqs) == 0:
+            print("ERROR: Impedance table is empty.")
             return None
 
-    t0 = tau_net(network)
-    t1 = tau_net(net)
-    dT = t1-t0
-    dTdV = dT/dv
-    print(f"dv = {dv} val={val}")
-    return (dTdV, dT, t0, t1)
+        f = np.asarray(freq, dtype=float)
+        if len(self.freqs) < 2:
+            dZ = np.zeros(f.shape, dtype=complex)
+        else:
+            i, t = self.indices(freq)
+            f0 = self.freqs[i]
+            f1 = self.freqs[i+1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dZ = np.where((f >= f0) & (f <= f1) & (f1 > f0), (self.Z[i+1] - self.Z[i])/(f1 - f0), 0)
+
+        return dZ if np.ndim(freq) > 0 else complex(dZ)
+
+def load_touchstone(filename:str):
+    """ Reads a one port Touchstone (.s1p) file and returns its impedance as
+    a TabulatedImpedance, or None if the file is invalid.
+
+    The option line "# <unit> <parameter> <format> R <Z0>" is honoured:
+    units Hz, kHz, MHz or GHz, parameter S, Z or Y (Z and Y normalized to
+    Z0, as in Touchstone 1.0) and format MA, DB or RI. The defaults are
+    "# GHz S MA R 50". Comments start with '!'.
+    """
+
+    units = {"HZ": 1, "KHZ": 1e3, "MHZ": 1e6, "GHZ": 1e9}
+    scale = 1e9
+    param = "S"
+    fmt = "MA"
+    Z0 = 50.0
+
+    freqs = []
+    values = []
+    lnum = 0
+
+    with open(filename) as file:
+        for line in file:
+            lnum += 1
+            words = line.split("!")[0].split()
+
+            if len(words) == 0:
+                continue
+
+            if words[0] == "#":
+                opts = [w.upper() for w in words[1:]]
+                k = 0
+                while k < len(opts):
+                    w = opts[k]
+                    if w in units:
+                        scale = units[w]
+                    elif w in ("S", "Z", "Y"):
+                        param = w
+                    elif w in ("MA", "DB", "RI"):
+                        fmt = w
+                    elif w == "R" and k + 1 < len(opts):
+                        k += 1
+                        try:
+                            Z0 = float(opts[k])
+                        except ValueError:
+                            print(f"ERROR: Invalid reference impedance '{opts[k]}' on line {lnum}.")
+                            return None
+                    else:
+                        print(f"ERROR: Unsupported option '{words[k+1]}' on line {lnum}.")
+                        return None
+                    k += 1
+                continue
+
+            if len(words) != 3:
+                print(f"ERROR: Expected 3 values on line {lnum}, found {len(words)}. Only one port files are supported.")
+                return None
+
+            try:
+                f, a, b = (float(w) for w in words)
+            except ValueError:
+                print(f"ERROR: Failed to convert values on line {lnum} to float.")
+                return None
+
+            if fmt == "RI":
+                v = complex(a, b)
+            else:
+                mag = 10**(a/20) if fmt == "DB" else a
+                v = mag*complex(math.cos(math.radians(b)), math.sin(math.radians(b)))
+
+            freqs.append(f*scale)
+            values.append(v)
+
+    v = np.array(values, dtype=complex)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if param == "S":
+            Z = Z0*(1 + v)/(1 - v)
+        elif param == "Z":
+            Z = Z0*v
+        else:
+            Z = Z0/v
+
+    return TabulatedImpedance(freqs, Z, filename)
 
-def sens_pcnt(network, param:str, val=1):
+def _cmul(a, b):
+    """ Multiplies two complex values. If either is a numpy array the product
+    is formed from real arithmetic so each element matches the result of
+    multiplying the corresponding scalars (numpy's vectorized complex multiply
+    can differ in the last bit).
     """
-    Same as sens_percent() except val is in percent-100
-    ie. val=1 -> multiplier of 1.01, val=0 -> multiplier 1, val 50 -> multiplier 1.5
 
-    has abbreviated return
+    if not isinstance(a, np.ndarray) and not isinstance(b, np.ndarray):
+        return a*b
+
+    a = np.asarray(a, dtype=complex)
+    b = np.asarray(b, dtype=complex)
+
+    out = np.empty(np.broadcast(a, b).shape, dtype=complex)
+    out.real = a.real*b.real - a.imag*b.imag
+    out.imag = a.real*b.imag + a.imag*b.real
+    return out
+
+def _cdiv(a, b):
+    """ Divides two complex values. If either is a numpy array the quotient is
+    formed from real arithmetic, using the same algorithm as Python's complex
+    type, so each element matches the result of dividing the scalars.
     """
 
-    return abs(sens_percent(network, param, 1+val/100.0)[0])
+    if not isinstance(a, np.ndarray) and not isinstance(b, np.ndarray):
+        return a/b
+
+    a = np.asarray(a, dtype=complex)
+    b = np.asarray(b, dtype=complex)
+    ar, ai, br, bi = a.real, a.imag, b.real, b.imag
+
+    big_r = np.abs(br) >= np.abs(bi)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rat = np.where(big_r, bi/br, br/bi)
+        denom = np.where(big_r, br + bi*rat, br*rat + bi)
+        re = np.where(big_r, (ar + ai*rat)/denom, (ar*rat + ai)/denom)
+        im = np.where(big_r, (ai - ar*rat)/denom, (ai*rat - ar)/denom)
 
-def sens_percent(network, param:str, val):
+    out = np.empty(re.shape, dtype=complex)
+    out.real = re
+    out.imag = im
+    return out
+
+def _cabs(z):
+    """ Magnitude of a complex value. Arrays use hypot, matching abs() of the
+    individual scalars exactly.
     """
-    val: multiplier (2 -> +100%, 1 -> no change, etc)
+
+    if not isinstance(z, np.ndarray):
+        return abs(z)
+
+    z = np.asarray(z, dtype=complex)
+    return np.hypot(z.real, z.imag)
+
+def pall(Z1:complex, Z2:complex):
+    """ Calculates the impedance of two parallel elements """
+    return _cdiv(_cmul(Z1, Z2), Z1+Z2)
+
+def _read_element(t, last_comp_name):
+    """ Reads one (Component, orientation) tuple from a circuit list and
+    verifies that it is valid. Returns (comp, orientation), or None if the
+    element is invalid.
     """
 
+    try:
+        #Read component
+        comp = t[0]
+        comp.Z_L(1) #Will fail if not a component class
+
+        #Read orientation
+        orientation = t[1]
+        if orientation.upper() != "SER" and orientation.upper() != "PAL":
+            print(f"ERROR: Invalid orientation '{orientation}' in circuit. Element: '{comp.name}'")
+            return None
+    except Exception as e:
+        print(f"ERROR: Invalid circuit element. {str(e)}")
+        try:
+            print(f"\tError occured with component: {comp.name}")
+        except:
+            if last_comp_name == None:
+                print("\tError occured with first component.")
+            else:
+                print(f"\tError occured because missing component object. Last valid component object: {last_comp_name}")
 
-    if type(val) != float and type(val) != float and type(val) != int:
-        print("ERROR: Value must be float, complex or int type.")
         return None
 
-    if param.upper() == "FREQ":
-        dv = network.freq*abs(val-1)
-    elif param.upper() == "Z_L":
-        dv = network.Z_l*abs(val-1)
-    elif param.upper() == "Z_S":
-        dv = network.Z_s*abs(val-1)
-    elif param.upper() == "VIN":
-        dv = network.V_in*abs(val-1)
-    else:
-        words = param.split()
-        if len(words) < 2:
-            print("ERROR: Invalid parameter. Fewer than two words.")
-            return None
-        element_name = words[0]
-        val_name = words[1]
+    return (comp, orientation)
+
+class CompiledCircuit:
+    """ Packed form of a circuit list, produced by compile_circuit(). The
+    values, type and orientation of every element are held in numpy arrays so
+    the ladder can be evaluated without per-element Python dispatch.
+
+    R, L, C - element values. These may have extra trailing dimensions (eg.
+              one per Monte Carlo draw), which broadcast ahead of the
+              frequency dimensions in every result.
+    types   - Passive enum value of each element (R=1, C=2, L=3)
+    series  - True for SER elements, False for PAL elements
+    names   - element names
+    index   - maps upper case element name to element index. If names are
+              repeated the last element wins, as in sensitivity().
+    """
 
-        element = None
-        for t in network.circ:
-            if t[0].name.upper() == element_name.upper():
-                element = t[0]
+    def __init__(self, R, L, C, types, series, names:list):
 
-        if element == None:
-            print("ERROR: Element not found.")
-            return None
+        self.R = np.asarray(R, dtype=float)
+        self.L = np.asarray(L, dtype=float)
+        self.C = np.asarray(C, dtype=float)
+        self.types = np.asarray(types, dtype=np.int8)
+        self.series = np.asarray(series, dtype=bool)
+        self.names = list(names)
 
-        if val_name.upper() == "C":
-            dv = element.val.C*abs(val-1)
-        elif val_name.upper() == "L":
-            dv = element.val.L*abs(val-1)
-        elif val_name.upper() == "R":
-            dv = element.val.R*abs(val-1)
+        self.index = {}
+        for i, name in enumerate(self.names):
+            self.index[name.upper()] = i
 
+        self._groups = None
 
-    return sensitivity(network, param, dv, True)
+    def __len__(self):
+        return len(self.names)
 
-def sensitivity(network, param:str, val, use_tau=False):
+    def __str__(self):
+        out = ""
+        for i in range(len(self)):
+            orientation = "SER" if self.series[i] else "PAL"
+            out = out + f"\t{self.names[i]}({Passive(int(self.types[i]))}) = R:{self.R[i]}, C:{self.C[i]}, L:{self.L[i]},\t {orientation}\n"
+        return out
 
-    if type(val) != float and type(val) != float and type(val) != int:
-        print("ERROR: Value must be float, complex or int type.")
-        return None
+    def __repr__(self):
+        return self.__str__()
 
-    net = copy.deepcopy(network)
+    def values(self, override:dict=None):
+        """ Returns the (R, L, C) arrays. override optionally maps element
+        indices to Values objects which replace those elements' values (see
+        Z_out()).
+        """
 
-    if param.upper() == "FREQ":
-        net.freq += val
-    elif param.upper() == "Z_L":
-        net.Z_l += val
-    elif param.upper() == "Z_S":
-        net.Z_s += val
-    elif param.upper() == "VIN":
-        net.V_in += val
+        if not override:
+            return (self.R, self.L, self.C)
+
+        R = self.R.copy()
+        L = self.L.copy()
+        C = self.C.copy()
+        for idx, v in override.items():
+            R[idx] = v.R
+            L[idx] = v.L
+            C[idx] = v.C
+
+        return (R, L, C)
+
+    def groups(self):
+        """ Returns a list of (Passive type, element indices) for each type
+        present, so each impedance formula runs once per type.
+        """
+
+        if self._groups is None:
+            self._groups = []
+            for t in (Passive.R, Passive.C, Passive.L):
+                idx = np.flatnonzero(self.types == t.value)
+                if len(idx) > 0:
+                    self._groups.append((t, idx))
+
+        return self._groups
+
+    @staticmethod
+    def _expand(R, L, C, freq):
+        """ Pads R, L and C to the same number of batch dimensions and appends
+        a unit dimension for every dimension of freq, so they broadcast to
+        (element, *batch, *freq).
+        """
+
+        R = np.asarray(R, dtype=float)
+        L = np.asarray(L, dtype=float)
+        C = np.asarray(C, dtype=float)
+        ndim = max(R.ndim, L.ndim, C.ndim)
+
+        out = []
+        for x in (R, L, C):
+            out.append(x.reshape(x.shape + (1,)*(ndim - x.ndim + np.ndim(freq))))
+
+        return out
+
+    def Z(self, freq, R=None, L=None, C=None):
+        """ Calculates the impedance of every element at freq (a float or
+        numpy array). Returns a complex array with one row per element,
+        matching Component.Z() exactly. R, L and C replace the packed values
+        if given.
+        """
+
+        stats = _stats.get()
+        if stats is not None:
+            t0 = time.perf_counter()
+
+        if R is None:
+            R = self.R
+        if L is None:
+            L = self.L
+        if C is None:
+            C = self.C
+
+        f = np.asarray(freq, dtype=float)
+        R, L, C = self._expand(R, L, C, f)
+        shape = np.broadcast(R, L, C, f).shape
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Z_L = np.broadcast_to(complex(0, 1)*(2*3.14159*f*L), shape)
+            Z_C = np.broadcast_to(complex(0, -1)/(2*3.14159*f*C), shape)
+            R = np.broadcast_to(R, shape)
+
+            #Elements without capacitance (or at DC) reduce to R + Z_L
+            Z = Z_L + R
+            cap = np.broadcast_to((C != 0) & (f != 0), Z.shape)
+
+            for t, idx in self.groups():
+                if t == Passive.C:
+                    Zg = R[idx] + Z_L[idx] + Z_C[idx]
+                elif t == Passive.L:
+                    Zg = pall(Z_L[idx] + R[idx], Z_C[idx])
+                else:
+                    Zg = Z_L[idx] + pall(R[idx], Z_C[idx])
+                Z[idx] = np.where(cap[idx], Zg, Z[idx])
+
+        if stats is not None:
+            stats.add("element_Z", time.perf_counter() - t0)
+
+        return Z
+
+    def _Z_scalar(self, f:float, R, L, C):
+        """ Calculates the element impedances at a single frequency with
+        Python complex arithmetic. Returns a list, matching Z() exactly.
+        """
+
+        stats = _stats.get()
+        if stats is not None:
+            t0 = time.perf_counter()
+
+        w = 2*3.14159*f
+        Z = []
+        for t, r, l, c in zip(self.types.tolist(), R.tolist(), L.tolist(), C.tolist()):
+            Z_L = complex(0, 1)*(w*l)
+            if c == 0 or f == 0:
+                Z.append(Z_L + r)
+                continue
+
+            Z_C = complex(0, -1)/(w*c)
+            if t == Passive.C.value:
+                Z.append(r + Z_L + Z_C)
+            elif t == Passive.L.value:
+                Z.append(pall(Z_L + r, Z_C))
+            else:
+                Z.append(Z_L + pall(r, Z_C))
+
+        if stats is not None:
+            stats.add("element_Z", time.perf_counter() - t0)
+
+        return Z
+
+    def dZ(self, freq, R=None, L=None, C=None):
+        """ Calculates the partial derivatives of every element's impedance
+        with respect to its R, L and C values and to frequency. Returns a
+        tuple of four arrays (dZ/dR, dZ/dL, dZ/dC, dZ/df) shaped like Z().
+
+        The parallel capacitance of inductors and resistors is differentiated
+        in admittance form, so the derivative is finite at C=0 (ie. the effect
+        of a small parasitic C). The derivative of a series capacitor with
+        zero capacitance is undefined and is returned as nan.
+        """
+
+        if R is None:
+            R = self.R
+        if L is None:
+            L = self.L
+        if C is None:
+            C = self.C
+
+        f = np.asarray(freq, dtype=float)
+        R, L, C = self._expand(R, L, C, f)
+        t = self.types.reshape(self.types.shape + (1,)*(R.ndim - 1))
+
+        j = complex(0, 1)
+        dw = 2*3.14159
+        w = dw*f
+        one = np.ones(np.broadcast(R, L, C, f).shape, dtype=complex)
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+
+            #Series capacitor
+            c_dC = np.where(C != 0, j/(w*C*C), complex(np.nan, np.nan))
+            c_df = j*dw*L + np.where(C != 0, j/(dw*f*f*C), 0)
+
+            #Inductor: Z = A/(1 + A*Yc), with A = R + jwL and Yc = jwC
+            A = R + j*w*L
+            D = 1 + A*j*w*C
+            g = 1/(D*D)
+            Zp = A/D
+            l_dC = -Zp*Zp*j*w
+            l_df = g*j*dw*L - Zp*Zp*j*dw*C
+
+            #Resistor: Z = jwL + R/(1 + R*Yc), with Yc = jwC
+            D = 1 + R*j*w*C
+            Zp = R/D
+            r_dR = 1/(D*D)
+            r_dC = -Zp*Zp*j*w
+            r_df = j*dw*L - Zp*Zp*j*dw*C
+
+            is_C = (t == Passive.C.value)
+            is_L = (t == Passive.L.value)
+
+            dR = np.where(is_C, one, np.where(is_L, g, r_dR))
+            dL = np.where(is_L, g*j*w, j*w*one)
+            dC = np.where(is_C, c_dC, np.where(is_L, l_dC, r_dC))
+            df = np.where(is_C, c_df, np.where(is_L, l_df, r_df))
+
+        return (dR*one, dL*one, dC*one, df*one)
+
+    def _generated(self, kind:str, freq, Zsource:complex, R, L, C):
+        """ Calls the generated function of this topology (see
+        ladder_function()). A single frequency is evaluated as a one element
+        array, so numpy scalar arithmetic never replaces array arithmetic.
+        """
+
+        f = np.asarray(freq, dtype=float)
+        scalar = (f.ndim == 0)
+        if scalar:
+            f = f.reshape(1)
+            Zsource = np.expand_dims(Zsource, -1)
+
+        #Element impedances are evaluated inside the generated code, so only
+        #the count is recorded; their time is part of the caller's event
+        stats = _stats.get()
+        if stats is not None:
+            stats.add("element_Z")
+
+        R, L, C = self._expand(R, L, C, f)
+        out = ladder_function(kind, self.types, self.series, C, f)(f, Zsource, R, L, C)
+
+        if not scalar:
+            return out
+        if kind == "Z_out":
+            return out[..., 0][()]
+        return tuple(np.asarray(x)[..., 0][()] for x in out)
+
+    def d2Z(self, freq, R=None, L=None, C=None):
+        """ Calculates the second partial derivatives of every element's
+        impedance with respect to pairs of its R, L and C values and
+        frequency. Returns a complex array indexed [element, i, j, ...], with
+        i and j in the order R, L, C, freq and the remaining axes shaped like
+        Z(). Derivatives involving C are nan for a capacitor with no
+        capacitance, as in dZ().
+        """
+
+        if R is None:
+            R = self.R
+        if L is None:
+            L = self.L
+        if C is None:
+            C = self.C
+
+        f = np.asarray(freq, dtype=float)
+        R, L, C = self._expand(R, L, C, f)
+        t = self.types.reshape(self.types.shape + (1,)*(R.ndim - 1))
+        shape = np.broadcast(R, L, C, f).shape
+
+        j = complex(0, 1)
+        dw = 2*3.14159
+        w = dw*f
+        zero = np.zeros(shape, dtype=complex)
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+
+            #Y_C = jwC and A = R + jwL, and their derivatives in the order
+            #R, L, C, freq. The only second derivatives are d2/dCdf of Y_C
+            #and d2/dLdf of A, both j*dw.
+            q = j*w*C
+            dq = [zero, zero, j*w + zero, j*dw*C + zero]
+
+            def P2(A, dA, ddA):
+                """ Second derivatives of A/(1 + A*Y_C) """
+                D = 1 + A*q
+                D3 = D*D*D
+                P = A/D
+                PA = 1/(D*D)
+                Pq = -P*P
+                PAA = -2*q/D3
+                PAq = -2*A/D3
+                Pqq = 2*P*P*P
+                H = [[PAA*dA[a]*dA[b] + PAq*(dA[a]*dq[b] + dA[b]*dq[a]) + Pqq*dq[a]*dq[b] for b in range(4)] for a in range(4)]
+                for a, b in ((1, 3), (3, 1)):
+                    H[a][b] = H[a][b] + PA*ddA
+                for a, b in ((2, 3), (3, 2)):
+                    H[a][b] = H[a][b] + Pq*j*dw
+                return H
+
+            #Inductor: Z = A/(1 + A*Y_C)
+            l_H = P2(R + j*w*L, [1 + zero, j*w + zero, zero, j*dw*L + zero], j*dw)
+
+            #Resistor: Z = jwL + R/(1 + R*Y_C)
+            r_H = P2(R + zero, [1 + zero, zero, zero, zero], 0)
+            for a, b in ((1, 3), (3, 1)):
+                r_H[a][b] = r_H[a][b] + j*dw
+
+            #Series capacitor: Z = R + jwL + 1/Y_C
+            nan = np.where(C != 0, 0, complex(np.nan, np.nan))
+            c_H = [[2*dq[a]*dq[b]/(q*q*q) + nan for b in range(4)] for a in range(4)]
+            c_H[2][3] = c_H[2][3] - j*dw/(q*q)
+            c_H[3][2] = c_H[2][3]
+            c_H[3][3] = np.where(C != 0, c_H[3][3], 0)
+            for a in range(4):
+                for b in range(4):
+                    if a != 2 and b != 2 and (a, b) != (3, 3):
+                        c_H[a][b] = zero
+            c_H[1][3] = j*dw + zero
+            c_H[3][1] = c_H[1][3]
+
+            is_C = (t == Passive.C.value)
+            is_L = (t == Passive.L.value)
+
+            H = np.array([[np.where(is_C, c_H[a][b], np.where(is_L, l_H[a][b], r_H[a][b])) for b in range(4)] for a in range(4)])
+
+        return np.moveaxis(H, (0, 1), (1, 2))
+
+    def Z_out(self, freq, Zsource:complex, R=None, L=None, C=None):
+        """ Calculates the output impedance of the ladder driven by Zsource,
+        as Z_out() does. R, L and C replace the packed values if given.
+        Frequency arrays and batches of values are evaluated by generated
+        code for this topology (see ladder_function()).
+        """
+
+        stats = _stats.get()
+        if stats is not None:
+            t0 = time.perf_counter()
+
+        if R is None:
+            R = self.R
+        if L is None:
+            L = self.L
+        if C is None:
+            C = self.C
+
+        #For a single frequency, numpy call overhead outweighs the arithmetic
+        if np.ndim(freq) == 0 and R.ndim == 1 and L.ndim == 1 and C.ndim == 1:
+            Ze = self._Z_scalar(freq, R, L, C)
+
+            Zout = Zsource
+            for k, ser in enumerate(self.series.tolist()):
+                if ser:
+                    Zout = Zout + Ze[k]
+                else:
+                    Zout = pall(Zout, Ze[k])
+        else:
+            Zout = self._generated("Z_out", freq, Zsource, R, L, C)
+
+        if stats is not None:
+            stats.add("Z_out", time.perf_counter() - t0)
+
+        return Zout
+
+    def grad_Z_out(self, freq, Zsource:complex, R=None, L=None, C=None):
+        """ Calculates the output impedance and its exact derivatives in one
+        pass. The ladder is walked once from the source to find each stage's
+        local derivatives, then once back from the load, applying the chain
+        rule through the SER/PAL recursion. Both passes run as generated
+        code for this topology (see ladder_function()).
+
+        Returns a tuple (Zout, dR, dL, dC, dZs, df), where dR, dL and dC have
+        one row per element holding d(Zout)/d(value), dZs is d(Zout)/d(Zsource)
+        and df is d(Zout)/d(freq).
+        """
+
+        stats = _stats.get()
+        if stats is not None:
+            t0 = time.perf_counter()
+
+        if R is None:
+            R = self.R
+        if L is None:
+            L = self.L
+        if C is None:
+            C = self.C
+
+        out = self._generated("grad_Z_out", freq, Zsource, R, L, C)
+
+        if stats is not None:
+            stats.add("grad_Z_out", time.perf_counter() - t0)
+
+        return out
+
+    def hess_Z_out(self, freq, Zsource:complex, R=None, L=None, C=None):
+        """ Calculates the output impedance with its exact first and second
+        derivatives with respect to every element value, Zsource and freq.
+
+        The second derivatives with respect to the element impedances are
+        found by carrying the tangent of every stage through the ladder from
+        the source, then differentiating the backward pass of grad_Z_out()
+        along all of them at once. They are then combined with each element's
+        own derivatives (dZ() and d2Z()).
+
+        Returns a tuple (Zout, grad, hess). Parameters are ordered R, L, C for
+        each element in turn, then Zsource, then freq. grad has one row per
+        parameter and hess one row and column per pair, each shaped like
+        Zout. Memory grows with the square of the ladder length.
+        """
+
+        Ze = self.Z(freq, R, L, C)
+        d = np.stack(self.dZ(freq, R, L, C), axis=1)
+        h = self.d2Z(freq, R, L, C)
+
+        n = len(self)
+        shape = np.broadcast(Zsource, Ze[0]).shape if n > 0 else np.shape(Zsource)
+
+        #T[k] is the derivative of the input of stage k with respect to each
+        #element impedance and Zsource (the last entry)
+        T = np.zeros((n + 1, n + 1) + shape, dtype=complex)
+        T[0, n] = 1
+
+        #First and second derivatives of each stage with respect to its input
+        #(Z) and its element (e)
+        A = []
+        B = []
+        d2 = []
+        Zout = Zsource
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for k, ser in enumerate(self.series.tolist()):
+                if ser:
+                    A.append(1)
+                    B.append(1)
+                    d2.append(None)
+                    Zout = Zout + Ze[k]
+                else:
+                    S = Zout + Ze[k]
+                    S3 = S*S*S
+                    A.append(Ze[k]*Ze[k]/(S*S))
+                    B.append(Zout*Zout/(S*S))
+                    d2.append((-2*Ze[k]*Ze[k]/S3, 2*Zout*Ze[k]/S3, -2*Zout*Zout/S3))
+                    Zout = pall(Zout, Ze[k])
+                T[k+1] = A[k]*T[k]
+                T[k+1, k] += B[k]
+
+            #Backward pass: lam is d(Zout)/d(stage output) as in grad_Z_out(),
+            #and mu its derivative along every tangent
+            lam = np.ones(shape, dtype=complex)
+            mu = np.zeros((n + 1,) + shape, dtype=complex)
+            g = np.empty((n + 1,) + shape, dtype=complex)
+            Hx = np.empty((n + 1, n + 1) + shape, dtype=complex)
+            for k in reversed(range(n)):
+                g[k] = lam*B[k]
+                if d2[k] is None:
+                    Hx[k] = mu
+                    continue
+                ZZ, Ze_, ee = d2[k]
+                Hx[k] = mu*B[k] + lam*Ze_*T[k]
+                Hx[k, k] += lam*ee
+                mu = mu*A[k] + lam*ZZ*T[k]
+                mu[k] += lam*Ze_
+                lam = lam*A[k]
+            g[n] = lam
+            Hx[n] = mu
+
+            #Chain rule onto the parameters. e holds the R, L, C parameters.
+            P = 3*n + 2
+            grad = np.empty((P,) + shape, dtype=complex)
+            hess = np.zeros((P, P) + shape, dtype=complex)
+            de = d[:, :3]
+            df = d[:, 3]
+
+            grad[:3*n] = (g[:n, np.newaxis]*de).reshape((3*n,) + shape)
+            grad[3*n] = g[n]
+            grad[3*n+1] = np.sum(g[:n]*df, axis=0)
+
+            Hee = Hx[:n, :n, np.newaxis, np.newaxis]*de[:, np.newaxis, :, np.newaxis]*de[np.newaxis, :, np.newaxis, :]
+            Hee = np.moveaxis(Hee, 2, 1)
+            idx = np.arange(n)
+            Hee[idx, :, idx, :] += g[:n, np.newaxis, np.newaxis]*h[:, :3, :3]
+            hess[:3*n, :3*n] = Hee.reshape((3*n, 3*n) + shape)
+
+            #v[l] is sum over k of df[k]*Hx[k, l]
+            v = np.sum(df[:, np.newaxis]*Hx[:n], axis=0)
+            fe = (v[:n, np.newaxis]*de + g[:n, np.newaxis]*h[:, 3, :3]).reshape((3*n,) + shape)
+            se = (Hx[n, :n, np.newaxis]*de).reshape((3*n,) + shape)
+            hess[3*n+1, :3*n] = fe
+            hess[:3*n, 3*n+1] = fe
+            hess[3*n, :3*n] = se
+            hess[:3*n, 3*n] = se
+            hess[3*n, 3*n] = Hx[n, n]
+            hess[3*n, 3*n+1] = v[n]
+            hess[3*n+1, 3*n] = v[n]
+            hess[3*n+1, 3*n+1] = np.sum(v[:n]*df + g[:n]*h[:, 3, 3], axis=0)
+
+        return (Zout, grad, hess)
+
+#Generated ladder functions, keyed by (kind, signature) (see ladder_function())
+_codegen_cache = _LRUCache(256)
+
+def _codegen_source(kind:str, sig:tuple):
+    """ Writes the source of a straight-line function for one ladder
+    signature (see ladder_function()). kind is "Z_out" or "grad_Z_out".
+
+    Elements are evaluated in groups of the same type and zero capacitance
+    state, as in CompiledCircuit.Z(), so the numpy call count does not grow
+    with the ladder length. Returns a tuple (source, constants), where
+    constants holds the index arrays of the groups named in the source.
+    """
+
+    groups = {}
+    for k, (t, ser, state) in enumerate(sig):
+        groups.setdefault((t, state), []).append(k)
+
+    guarded = any(state != 1 for t, ser, state in sig)
+    constants = {}
+    body = ["w = 2*3.14159*f"]
+    if kind == "grad_Z_out":
+        body.append("dw = 2*3.14159")
+        body.append("n = %d" % len(sig))
+
+    #Where each element's impedance lives, as (group, position)
+    where_is = {}
+    sels = []
+    for g, ((t, state), idx) in enumerate(groups.items()):
+
+        #Contiguous groups are sliced, so no values are copied
+        if idx == list(range(idx[0], idx[-1] + 1)):
+            sel = "%d:%d" % (idx[0], idx[-1] + 1)
+        else:
+            sel = "I%d" % g
+            constants[sel] = np.array(idx)
+        sels.append(sel)
+        for j, k in enumerate(idx):
+            where_is[k] = (g, j)
+
+        body.append(f"r = R[{sel}]")
+        body.append(f"l = L[{sel}]")
+        body.append(f"c = C[{sel}]")
+        body.append("ZL = J*(w*l)")
+        if state == 0:
+            body.append(f"Z{g} = ZL + r")
+        else:
+            body.append("ZC = NJ/(w*c)")
+            if t == Passive.C.value:
+                z = "r + ZL + ZC"
+            elif t == Passive.L.value:
+                z = "pall(ZL + r, ZC)"
+            else:
+                z = "ZL + pall(r, ZC)"
+            if state == 2:
+                z = f"where((c != 0) & (f != 0), {z}, ZL + r)"
+            body.append(f"Z{g} = {z}")
+
+        if kind == "grad_Z_out":
+            #Local derivatives of the element impedances, as CompiledCircuit.dZ()
+            if t == Passive.C.value:
+                body.append(f"pR{g} = 1")
+                body.append(f"pL{g} = J*w")
+                if state == 1:
+                    body.append(f"pC{g} = J/(w*c*c)")
+                    body.append(f"pf{g} = J*dw*l + J/(dw*f*f*c)")
+                else:
+                    body.append(f"pC{g} = where(c != 0, J/(w*c*c), NAN)")
+                    body.append(f"pf{g} = J*dw*l + where(c != 0, J/(dw*f*f*c), 0)")
+            elif t == Passive.L.value:
+                body.append("A = r + J*w*l")
+                body.append("D = 1 + A*J*w*c")
+                body.append("G = 1/(D*D)")
+                body.append("Zp = A/D")
+                body.append(f"pR{g} = G")
+                body.append(f"pL{g} = G*J*w")
+                body.append(f"pC{g} = -Zp*Zp*J*w")
+                body.append(f"pf{g} = G*J*dw*l - Zp*Zp*J*dw*c")
+            else:
+                body.append("D = 1 + r*J*w*c")
+                body.append("Zp = r/D")
+                body.append(f"pR{g} = 1/(D*D)")
+                body.append(f"pL{g} = J*w")
+                body.append(f"pC{g} = -Zp*Zp*J*w")
+                body.append(f"pf{g} = J*dw*l - Zp*Zp*J*dw*c")
+
+    #Forward pass through the ladder, keeping each PAL stage's local
+    #derivatives (a with respect to the previous stage, b to the element)
+    body.append("Z = Z_s")
+    for k, (t, ser, state) in enumerate(sig):
+        Ze = "Z%d[%d]" % where_is[k]
+        if ser:
+            body.append(f"Z = Z + {Ze}")
+        else:
+            if kind == "grad_Z_out":
+                body.append(f"S = Z + {Ze}")
+                body.append(f"a{k} = {Ze}*{Ze}/(S*S)")
+                body.append(f"b{k} = Z*Z/(S*S)")
+            body.append(f"Z = pall(Z, {Ze})")
+
+    if kind == "Z_out":
+        body.append("return Z")
     else:
-        words = param.split()
-        if len(words) < 2:
-            print("ERROR: Invalid parameter. Fewer than two words.")
-            return None
-        element_name = words[0]
-        val_name = words[1]
+        body.append("shape = broadcast(Z, Z0[0]).shape if n > 0 else np.shape(Z)")
+        body.append("one = ones(shape, dtype=complex)")
+
+        #Backward pass, s is d(Zout)/d(stage output)
+        body.append("s = one")
+        body.append("dZe = empty((n,) + shape, dtype=complex)")
+        for k in reversed(range(len(sig))):
+            if sig[k][1]:
+                body.append(f"dZe[{k}] = s*1")
+            else:
+                body.append(f"dZe[{k}] = s*b{k}")
+                body.append(f"s = s*a{k}")
+
+        for p in ("R", "L", "C", "f"):
+            body.append(f"p{p} = empty((n,) + shape, dtype=complex)")
+            for g, sel in enumerate(sels):
+                body.append(f"p{p}[{sel}] = p{p}{g}*one")
+        body.append("return (Z, dZe*pR, dZe*pL, dZe*pC, s, sum(dZe*pf, axis=0))")
+
+    lines = [f"def {kind}(f, Z_s, R, L, C):"]
+    if guarded or kind == "grad_Z_out":
+        lines.append("    with errstate(divide='ignore', invalid='ignore', over='ignore'):")
+        lines.extend("        " + b for b in body)
+    else:
+        lines.extend("    " + b for b in body)
+
+    return ("\n".join(lines) + "\n", constants)
+
+def ladder_function(kind:str, types, series, C, freq):
+    """ Returns a generated function evaluating Z_out (kind "Z_out") or
+    Z_out and its derivatives (kind "grad_Z_out", returning the same tuple
+    as CompiledCircuit.grad_Z_out()) for one ladder topology. The function
+    is called as func(freq, Z_s, R, L, C), with R, L and C expanded as in
+    CompiledCircuit._expand().
+
+    The element types, SER/PAL sequence and which capacitances are zero are
+    fixed into straight-line numpy code, so no per-element dispatch is left:
+    only the impedance formulas each element needs are evaluated, and the
+    ladder recursion is unrolled. Elements whose C is zero in only some rows
+    of a batch, and every element if freq includes DC, keep the np.where()
+    guards of CompiledCircuit.Z(). Functions are generated once per
+    signature and the most recently used are cached (see _LRUCache). The arithmetic is that of CompiledCircuit.Z() and
+    dZ() followed by the SER/PAL recursion, so results are unchanged to the
+    last bit.
+    """
+
+    dc = bool(np.any(np.asarray(freq) == 0))
+    C = np.asarray(C, dtype=float)
+    nonzero = (C != 0).reshape(len(C), -1) if len(C) > 0 else np.zeros((0, 1), dtype=bool)
+    sig = []
+    for t, ser, some, every in zip(np.asarray(types).tolist(), np.asarray(series).tolist(), np.any(nonzero, axis=1).tolist(), np.all(nonzero, axis=1).tolist()):
+        if not some:
+            state = 0
+        elif every and not dc:
+            state = 1
+        else:
+            state = 2
+        sig.append((t, ser, state))
+    key = (kind, tuple(sig))
+
+    func = _codegen_cache.get(key)
+    if func is None:
+        source, constants = _codegen_source(kind, key[1])
+        namespace = {"np": np, "J": np.complex128(complex(0, 1)), "NJ": np.complex128(complex(0, -1)), "NAN": complex(np.nan, np.nan), "pall": pall, "where": np.where, "errstate": np.errstate, "ones": np.ones, "empty": np.empty, "broadcast": np.broadcast, "sum": np.sum}
+        namespace.update(constants)
+        exec(compile(source, f"<ladder {kind}>", "exec"), namespace)
+        func = namespace[kind]
+        _codegen_cache.put(key, func)
+
+    return func
+
+#Recently compiled circuits, keyed by their contents (see _circuit_key())
+_compile_cache = _LRUCache(64)
+
+def _circuit_key(circ):
+    """ Returns a tuple of everything compile_circuit() reads from a circuit
+    list: the orientation, type, name and values of each component. Two lists
+    with the same key compile to the same CompiledCircuit. Returns None if
+    the list cannot be read.
+    """
+
+    try:
+        return tuple((t[1], t[0].type, t[0].name, t[0].val.R, t[0].val.L, t[0].val.C) for t in circ)
+    except Exception:
+        return None
+
+def compile_circuit(circ):
+    """ Validates a circuit list (see load_circuit() for format info) once and
+    packs it into a CompiledCircuit. A CompiledCircuit is returned unchanged.
+    Returns None if the circuit is invalid.
 
-        element = None
-        for t in net.circ:
-            if t[0].name.upper() == element_name.upper():
-                element = t[0]
+    The result is cached by the contents of the list (see _circuit_key()),
+    so passing the same circuit to every call validates (and warns about) it
+    only once, and changing a component value compiles it afresh. Cached
+    CompiledCircuits are shared between callers and must not be modified.
+    """
+
+    if isinstance(circ, CompiledCircuit):
+        return circ
+
+    key = _circuit_key(circ)
+    if key is not None:
+        cc = _compile_cache.get(key)
+        if cc is not None:
+            return cc
+
+    stats = _stats.get()
+    if stats is not None:
+        t0 = time.perf_counter()
+
+    R = []
+    L = []
+    C = []
+    types = []
+    series = []
+    names = []
+    last_comp_name = None
+
+    for t in circ:
 
-        if element == None:
-            print("ERROR: Element not found.")
+        element = _read_element(t, last_comp_name)
+        if element is None:
             return None
+        comp, orientation = element
+        last_comp_name = comp.name
 
-        if val_name.upper() == "C":
-            element.val.C += val
-        elif val_name.upper() == "L":
-            element.val.L += val
-        elif val_name.upper() == "R":
-            element.val.R += val
-        else:
-            print(f"ERROR: Invalid element parameter '{val_name}'.")
+        if comp.type not in (Passive.R, Passive.C, Passive.L):
+            print(f"ERROR: component {comp.name} does not have a valid type {comp.type}.")
             return None
 
-    if use_tau:
-        t0 = tau_net(network)
-        t1 = tau_net(net)
-        dT = t1-t0
-        dTdV = dT/val
-        return (dTdV, dT, t0, t1)
+        if comp.type == Passive.C and comp.val.C == 0:
+            print(f"WARNING: Capacitor {comp.name} has 0 capacitance. Will behave like R or L.")
 
-    P0 = P_net(network)
-    P1 = P_net(net)
+        R.append(comp.val.R)
+        L.append(comp.val.L)
+        C.append(comp.val.C)
+        types.append(comp.type.value)
+        series.append(orientation.upper() == "SER")
+        names.append(comp.name)
 
-    dP = P1-P0
+    cc = CompiledCircuit(R, L, C, types, series, names)
+    if key is not None:
+        _compile_cache.put(key, cc)
 
-    dPdV = dP/val
+    if stats is not None:
+        stats.add("compile_circuit", time.perf_counter() - t0)
 
-    return (dPdV, dP, P0, P1)
+    return cc
 
-def get_spectrum_pcnt(network, param, fs, val=1):
+class NetlistError(Exception):
+    """ Raised by load_netlists() for an invalid netlist. filename and lnum
+    give the location of the offending line.
+    """
+
+    def __init__(self, message:str, filename:str=None, lnum:int=None):
+
+        self.message = message
+        self.filename = filename
+        self.lnum = lnum
 
-    f_orig = network.freq
+        super().__init__(self.__str__())
 
-    sens = []
+    def __str__(self):
+        return f"{self.filename}:{self.lnum}: {self.message}"
+
+class NetlistBatch:
+    """ Many circuits packed end to end into flat arrays, as produced by
+    load_netlists(). The elements of circuit i are offsets[i] to
+    offsets[i+1], with the same fields as CompiledCircuit.
+
+    R, L, C - element values
+    types   - Passive enum value of each element (R=1, C=2, L=3)
+    series  - True for SER elements, False for PAL elements
+    names   - element names
+    offsets - start of each circuit, plus the total element count
+    nets    - name of each circuit
+    """
 
-    for f in fs:
-        network.freq = f
-        sens.append(sens_pcnt(network, param, val))
+    def __init__(self, R, L, C, types, series, names, offsets, nets):
 
-    network.freq = f_orig
+        self.R = np.asarray(R, dtype=float)
+        self.L = np.asarray(L, dtype=float)
+        self.C = np.asarray(C, dtype=float)
+        self.types = np.asarray(types, dtype=np.int8)
+        self.series = np.asarray(series, dtype=bool)
+        self.names = np.asarray(names, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.nets = np.asarray(nets, dtype=str)
 
-    return sens
+    def __len__(self):
+        return len(self.nets)
 
-def get_spectrum_val(network, param, fs, val):
+    def __str__(self):
+        return f"NetlistBatch: {len(self)} circuits, {len(self.R)} elements"
 
-    f_orig = network.freq
+    def __repr__(self):
+        return self.__str__()
 
-    sens = []
+    def __getitem__(self, i:int):
+        """ Returns circuit i as a CompiledCircuit sharing the packed arrays.
+        Negative indices count from the end.
+        """
 
-    for f in fs:
-        network.freq = f
-        sens.append(abs(sensitivity(network, param, val, True)[0]))
-        # sens.append(sens_pcnt(network, param, val))
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(f"Circuit index out of range for a batch of {len(self)}")
 
-    network.freq = f_orig
+        a = self.offsets[i]
+        b = self.offsets[i+1]
+        return CompiledCircuit(self.R[a:b], self.L[a:b], self.C[a:b], self.types[a:b], self.series[a:b], self.names[a:b].tolist())
 
-    return sens
+    def save(self, filename:str):
+        """ Writes the batch to a .npz file, which load_batch() reads back
+        without parsing any text.
+        """
 
-def get_spectrum_norm(network, param, fs, val=1, abs_val=None):
+        np.savez(filename, R=self.R, L=self.L, C=self.C, types=self.types, series=self.series, names=self.names, offsets=self.offsets, nets=self.nets)
+
+def load_batch(filename:str):
+    """ Reads a NetlistBatch written by NetlistBatch.save() """
+
+    with np.load(filename, allow_pickle=False) as f:
+        return NetlistBatch(f["R"], f["L"], f["C"], f["types"], f["series"], f["names"], f["offsets"], f["nets"])
+
+def _parse_netlists(lines, filename:str, default_net:str, out:dict):
+    """ Parses the .mc lines of one file or stream, appending each element to
+    the lists in out. A line "NET <name>" starts a new circuit; elements
+    before the first NET line belong to a circuit named default_net.
+    Raises NetlistError for invalid lines.
+    """
+
+    types = {"R": Passive.R.value, "C": Passive.C.value, "L": Passive.L.value}
+    started = False
+
+    for lnum, line in enumerate(lines, 1):
 
-    f_orig = network.freq
+        words = line.split()
 
-    sens = []
+        #Skip blank lines and comments
+        if len(words) == 0 or words[0][0] == '#':
+            continue
 
-    for f in fs:
-        network.freq = f
-        if abs_val is not None:
-            sens.append(abs(sensitivity(network, param, abs_val, use_tau=True)[1]))
+        if words[0].upper() == "NET":
+            if len(words) != 2:
+                raise NetlistError("Expected 'NET <name>'.", filename, lnum)
+            out["offsets"].append(len(out["R"]))
+            out["nets"].append(words[1])
+            started = True
+            continue
+
+        if len(words) < 5:
+            raise NetlistError("Fewer than 5 words.", filename, lnum)
+
+        orientation = words[0].upper()
+        if orientation != "SER" and orientation != "PAL":
+            raise NetlistError(f"Unrecognized orientation token '{words[0]}'. Acceptable tokens are 'SER' and 'PAL'.", filename, lnum)
+
+        t = types.get(words[2].upper())
+        if t is None:
+            raise NetlistError(f"Component {words[1]} does not have a valid type '{words[2]}'.", filename, lnum)
+
+        #Parameter/value pairs, as in Component.read_vals()
+        vals = {"R": 0.0, "L": 0.0, "C": 0.0}
+        for w in range(3, len(words)-1, 2):
+            p = words[w].upper()
+            if p in vals:
+                try:
+                    vals[p] = float(words[w+1])
+                except ValueError:
+                    raise NetlistError(f"Failed to convert {words[w+1]} to float.", filename, lnum) from None
+
+        if not started:
+            out["offsets"].append(len(out["R"]))
+            out["nets"].append(default_net)
+            started = True
+
+        out["R"].append(vals["R"])
+        out["L"].append(vals["L"])
+        out["C"].append(vals["C"])
+        out["types"].append(t)
+        out["series"].append(orientation == "SER")
+        out["names"].append(words[1])
+
+def load_netlists(source):
+    """ Reads many circuits in one pass into a NetlistBatch. Unlike
+    load_circuit(), no Component objects are built, and problems raise a
+    NetlistError giving the file and line number.
+
+    source can be:
+        * a directory - every .mc file in it is read, in name order
+        * a .mc file
+        * an open text stream (or any iterable of lines)
+    Each file or stream uses the .mc format (see load_circuit()), and may
+    hold several circuits, each started by a line "NET <name>". Elements
+    before the first NET line form one circuit named after the file.
+    """
+
+    out = {"R": [], "L": [], "C": [], "types": [], "series": [], "names": [], "offsets": [], "nets": []}
+
+    if isinstance(source, (str, os.PathLike)):
+        if os.path.isdir(source):
+            files = [os.path.join(source, f) for f in sorted(os.listdir(source)) if f.endswith(".mc")]
         else:
-            sens.append(abs(sens_percent(network, param, 1+val/100.0)[1]))
+            files = [source]
 
-    network.freq = f_orig
+        for filename in files:
+            with open(filename) as file:
+                _parse_netlists(file, filename, os.path.splitext(os.path.basename(filename))[0], out)
+    else:
+        _parse_netlists(source, getattr(source, "name", "<stream>"), "net", out)
 
-    return sens
+    out["offsets"].append(len(out["R"]))
+
+    return NetlistBatch(out["R"], out["L"], out["C"], out["types"], out["series"], out["names"], out["offsets"], out["nets"])
+
+class LadderCache:
+    """ Caches the partial impedance after every stage of a ladder at a fixed
+    set of frequencies, and the transfer of every suffix of stages. The
+    stages after element k map the impedance they are driven from to the
+    output impedance by a bilinear form, (D*Z + B)/(C*Z + A), whose
+    coefficients are the ABCD product of those stages (see ABCDLadder).
+    A trial change to element k therefore costs one stage fold onto the
+    cached prefix and one bilinear evaluation, so trying every element in
+    turn is O(N) per frequency. Changing an element (or Z_s) invalidates
+    only the cached prefixes after it (or the suffixes before it).
+
+    Trial results agree with Z_out() to rounding error; they are exact for
+    the last element and when nothing is changed.
+    """
+
+    def __init__(self, circ, freq, Z_s:complex):
+
+        cc = compile_circuit(circ)
+        if cc is None:
+            raise ValueError("Invalid circuit")
+
+        self.freq = freq
+        self.cc = CompiledCircuit(cc.R.copy(), cc.L.copy(), cc.C.copy(), cc.types, cc.series, cc.names)
+        self.series = self.cc.series.tolist()
+
+        #Element impedances, and prefix[k] = impedance seen by element k
+        if np.ndim(freq) == 0:
+            self.Ze = self.cc._Z_scalar(freq, self.cc.R, self.cc.L, self.cc.C)
+        else:
+            self.Ze = list(self.cc.Z(freq))
+        self.prefix = [Z_s] + [None]*len(self.cc)
+        self.valid = 0 # prefix[0..valid] are up to date
+
+        #suffix[k] = (A, B, C, D) of stages k onward, scaled to a largest entry of 1
+        n = len(self.cc)
+        self.suffix = [None]*n + [(1, 0, 0, 1)]
+        self.suffix_valid = n # suffix[suffix_valid..n] are up to date
+
+    def _element_Z(self, k:int, R:float, L:float, C:float):
+        """ Calculates the impedance of element k with the given values """
+
+        cc = self.cc
+        single = CompiledCircuit([R], [L], [C], cc.types[k:k+1], cc.series[k:k+1], cc.names[k:k+1])
+        if np.ndim(self.freq) == 0:
+            return single._Z_scalar(self.freq, single.R, single.L, single.C)[0]
+        return single.Z(self.freq)[0]
+
+    def _stage(self, k:int, Zin, Ze):
+        """ Folds element k (impedance Ze) onto the impedance Zin """
+
+        if self.series[k]:
+            return Zin + Ze
+        return pall(Zin, Ze)
+
+    def _update(self, k:int):
+        """ Brings prefix[0..k] up to date """
+
+        while self.valid < k:
+            i = self.valid
+            self.prefix[i+1] = self._stage(i, self.prefix[i], self.Ze[i])
+            self.valid += 1
+
+    def _update_suffix(self, k:int):
+        """ Brings suffix[k..n] up to date """
+
+        while self.suffix_valid > k:
+            i = self.suffix_valid - 1
+            A, B, C, D = self.suffix[i+1]
+            Z = self.Ze[i]
+
+            #SER stage [[1, Z], [0, 1]]; PAL stage [[1, 0], [1/Z, 1]] scaled by Z
+            if self.series[i]:
+                T = (A + Z*C, B + Z*D, C, D)
+            else:
+                T = (Z*A, Z*B, A + Z*C, B + Z*D)
+
+            with np.errstate(invalid='ignore'):
+                scale = np.maximum(np.maximum(np.abs(T[0]), np.abs(T[1])), np.maximum(np.abs(T[2]), np.abs(T[3])))
+                scale = np.where((scale > 0) & np.isfinite(scale), scale, 1)
+            self.suffix[i] = tuple(t/scale for t in T)
+            self.suffix_valid -= 1
+
+    def Z_out(self):
+        """ Returns the output impedance of the ladder """
+
+        self._update(len(self.cc))
+        return self.prefix[-1]
+
+    def Z_out_with(self, k:int, R:float=None, L:float=None, C:float=None):
+        """ Returns the output impedance if element k's values were replaced
+        by R, L and/or C, without changing the cache. Stage k is folded onto
+        the cached impedance seen by element k and the stages after it are
+        applied from their cached transfer.
+        """
+
+        cc = self.cc
+        Ze = self._element_Z(k, cc.R[k] if R is None else R, cc.L[k] if L is None else L, cc.C[k] if C is None else C)
+
+        self._update(k)
+        self._update_suffix(k+1)
+        Zk = self._stage(k, self.prefix[k], Ze)
+        if k == len(cc) - 1:
+            return Zk
+
+        A, B, C, D = self.suffix[k+1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Zout = (D*Zk + B)/(C*Zk + A)
+
+        #Fall back to folding every stage where the transfer is degenerate
+        bad = ~np.isfinite(Zout)
+        if np.any(bad):
+            Zfold = Zk
+            for i in range(k+1, len(cc)):
+                Zfold = self._stage(i, Zfold, self.Ze[i])
+            Zout = np.where(bad, Zfold, Zout)[()]
+
+        return Zout
+
+    def set_element(self, k:int, R:float=None, L:float=None, C:float=None):
+        """ Changes the values of element k. Cached stages after k, and
+        suffixes that include k, are invalidated.
+        """
+
+        cc = self.cc
+        if R is not None:
+            cc.R[k] = R
+        if L is not None:
+            cc.L[k] = L
+        if C is not None:
+            cc.C[k] = C
+
+        self.Ze[k] = self._element_Z(k, cc.R[k], cc.L[k], cc.C[k])
+        self.valid = min(self.valid, k)
+        self.suffix_valid = max(self.suffix_valid, k+1)
+
+    def set_Z_s(self, Z_s:complex):
+        """ Changes the source impedance, invalidating every cached prefix.
+        The suffix transfers do not depend on Z_s and are kept.
+        """
+
+        self.prefix[0] = Z_s
+        self.valid = 0
+
+class ABCDLadder:
+    """ Transfer (ABCD) matrix form of a ladder at a fixed set of frequencies.
+    Each SER stage is the matrix [[1, Z], [0, 1]] and each PAL stage is
+    [[1, 0], [1/Z, 1]]. The products of the matrices before and after every
+    element are kept, so the whole ladder with any one element changed is
+    prefix[k] @ M @ suffix[k+1], and the derivatives with respect to every
+    element come from one local update each: O(N) per frequency in total.
+
+    The products are rescaled as they are built so long ladders do not
+    overflow; prefix_log and suffix_log hold the log of each scale factor.
+    Results agree with Z_out() to rounding error (they are not bit exact).
+    """
+
+    def __init__(self, circ, freq):
+
+        cc = compile_circuit(circ)
+        if cc is None:
+            raise ValueError("Invalid circuit")
+
+        self.cc = cc
+        self.freq = np.asarray(freq, dtype=float)
+        self.Ze = cc.Z(self.freq)
+
+        n = len(cc)
+        shape = self.Ze.shape[1:]
+        self.M = self._stages(self.Ze, cc.series)
+
+        #prefix[k] ~ M[0] @ ... @ M[k-1], suffix[k] ~ M[k] @ ... @ M[n-1]
+        self.prefix = np.empty((n+1,) + shape + (2, 2), dtype=complex)
+        self.suffix = np.empty((n+1,) + shape + (2, 2), dtype=complex)
+        self.prefix_log = np.zeros((n+1,) + shape)
+        self.suffix_log = np.zeros((n+1,) + shape)
+        self.prefix[0] = np.eye(2)
+        self.suffix[n] = np.eye(2)
+        for k in range(n):
+            self.prefix[k+1], s = self._normalize(self.prefix[k] @ self.M[k])
+            self.prefix_log[k+1] = self.prefix_log[k] + s
+        for k in reversed(range(n)):
+            self.suffix[k], s = self._normalize(self.M[k] @ self.suffix[k+1])
+            self.suffix_log[k] = self.suffix_log[k+1] + s
+
+    def _stages(self, Ze, series):
+        """ Builds the ABCD matrix of each element from its impedance """
+
+        M = np.zeros(Ze.shape + (2, 2), dtype=complex)
+        M[..., 0, 0] = 1
+        M[..., 1, 1] = 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            M[series, ..., 0, 1] = Ze[series]
+            M[~series, ..., 1, 0] = 1/Ze[~series]
+
+        return M
+
+    def _normalize(self, T):
+        """ Scales each matrix in T to a largest entry of 1. Returns the
+        scaled matrices and the log of the scale factors.
+        """
+
+        scale = np.max(np.abs(T), axis=(-2, -1))
+        scale = np.where((scale > 0) & np.isfinite(scale), scale, 1)
+
+        return (T/scale[..., np.newaxis, np.newaxis], np.log(scale))
+
+    def _terminate(self, T, Z_s:complex):
+        """ Output impedance of the two-port T driven from Z_s """
+
+        A = T[..., 0, 0]
+        B = T[..., 0, 1]
+        C = T[..., 1, 0]
+        D = T[..., 1, 1]
+
+        return (D*Z_s + B)/(C*Z_s + A)
+
+    def Z_out(self, Z_s:complex):
+        """ Returns the output impedance of the ladder driven by Z_s """
+
+        return self._terminate(self.prefix[-1], Z_s)
+
+    def Z_out_with(self, k:int, Z_s:complex, R:float=None, L:float=None, C:float=None):
+        """ Returns the output impedance if element k's values were replaced
+        by R, L and/or C, from a single local matrix update.
+        """
+
+        cc = self.cc
+        single = CompiledCircuit([cc.R[k] if R is None else R], [cc.L[k] if L is None else L], [cc.C[k] if C is None else C], cc.types[k:k+1], cc.series[k:k+1], cc.names[k:k+1])
+        M = self._stages(single.Z(self.freq), single.series)[0]
+
+        return self._terminate(self.prefix[k] @ M @ self.suffix[k+1], Z_s)
+
+    def dZ_out(self, Z_s:complex):
+        """ Calculates the derivatives of the output impedance with respect to
+        the impedance of every element, and to Z_s.
+
+        Returns a tuple (dZe, dZs), where dZe has one row per element.
+        """
+
+        #With Zout = N/Dn, N = B + Z_s*D and Dn = A + Z_s*C, and every stage
+        #having AD - BC = 1, the chain rule collapses to
+        #d(Zout)/d(Z) = (p/Dn)^2 for a SER stage and d(Zout)/d(Y) = -(p/Dn)^2
+        #for a PAL stage, where p is an entry of [1, Z_s] @ prefix[k].
+        P = self.prefix[:-1]
+        S = self.suffix[1:]
+        series = self.cc.series.reshape((-1,) + (1,)*self.freq.ndim)
+
+        p0 = P[..., 0, 0] + Z_s*P[..., 1, 0]
+        p1 = P[..., 0, 1] + Z_s*P[..., 1, 1]
+        a0 = p0*self.M[..., 0, 0] + p1*self.M[..., 1, 0]
+        a1 = p0*self.M[..., 0, 1] + p1*self.M[..., 1, 1]
+        Dn = a0*S[..., 0, 0] + a1*S[..., 1, 0]
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            ratio = np.where(series, p0, p1/self.Ze)/Dn*np.exp(-self.suffix_log[1:])
+            T = self.prefix[-1]
+            dZs = np.exp(-self.prefix_log[-1])/(T[..., 0, 0] + Z_s*T[..., 1, 0])
+
+        return (ratio*ratio, dZs*dZs)
+
+    def tau(self, Z_s:complex, Z_l:complex):
+        """ Calculates tau for a load Z_l """
+
+        return tau_load(Z_l, self.Z_out(Z_s))
+
+    def sensitivities(self, Z_s:complex, Z_l:complex):
+        """ Calculates the exact derivatives of tau with respect to the R, L
+        and C value of every element.
+
+        Returns a tuple (dR, dL, dC) with one row per element, as in
+        CompiledCircuit.grad_Z_out().
+        """
+
+        Zout = self.Z_out(Z_s)
+        dZe = self.dZ_out(Z_s)[0]
+        pR, pL, pC, _ = self.cc.dZ(self.freq)
+
+        S = Z_l + Zout
+        dT_dZ = 4*Z_l*(Z_l - Zout)/(S*S*S)
+
+        return (dT_dZ*dZe*pR, dT_dZ*dZe*pL, dT_dZ*dZe*pC)
+
+def Z_out(circuit:list, freq, Zsource:complex, override:dict=None):
+    """ Takes a circuit list (see load_circuit for format info) and frequency
+    and calculates the equivilient output impedance of the network.
+
+    circuit can also be a CompiledCircuit. A list is validated and packed
+    on its first call and the packed form reused while it is unchanged (see
+    compile_circuit()).
+
+    freq can be a float or a numpy array of frequencies. If an array is given,
+    the ladder is evaluated for every frequency at once and an array of
+    impedances is returned.
+
+    override optionally maps the index of an element in the circuit list to a
+    Values object to use in place of that component's values. This lets a
+    perturbed network be evaluated without copying or modifying it.
+    """
+
+    cc = compile_circuit(circuit)
+    if cc is None:
+        return None
+
+    R, L, C = cc.values(override)
+
+    return cc.Z_out(freq, Zsource, R, L, C)
+
+def _impedance(Z, freq):
+    """ Returns the impedance Z at freq. Z is a constant or a
+    TabulatedImpedance, which is interpolated over the whole of freq at once.
+    """
+
+    if isinstance(Z, TabulatedImpedance):
+        return Z(freq)
+
+    return Z
+
+def _impedance_slope(Z, freq):
+    """ Returns dZ/dfreq for Z as in _impedance(): the slope of a
+    TabulatedImpedance, or 0 for a constant.
+    """
+
+    if isinstance(Z, TabulatedImpedance):
+        return Z.slope(freq)
+
+    return 0
+
+def P_load(Z_l:complex, Z_s:complex, Vin:float=1):
+
+    return _cdiv(Vin**2 * Z_l.real, _cmul(Z_l+Z_s, Z_l+Z_s))
+
+def tau_load(Z_l:complex, Z_s:complex):
+    """ Calculates tau for a load Z_l driven from an impedance Z_s """
+
+    return _cdiv(_cmul(4*Z_l, Z_s), Z_l**2 + _cmul(2*Z_l, Z_s) + _cmul(Z_s, Z_s))
+
+def P_net(network, freq=None, Z_s=None, Z_l=None, V_in=None, override:dict=None):
+    """ Calculates the power delivered to the load. freq, Z_s, Z_l, V_in and
+    override (see Z_out()) replace the network's own values if given, so a
+    perturbed network can be evaluated without being copied.
+    """
+
+    if freq is None:
+        freq = network.freq
+    if Z_s is None:
+        Z_s = network.Z_s
+    if Z_l is None:
+        Z_l = network.Z_l
+    if V_in is None:
+        V_in = network.V_in
+
+    Z_s = _impedance(Z_s, freq)
+    Z_l = _impedance(Z_l, freq)
+
+    return P_load(Z_l, Z_out(network.circ, freq, Z_s, override), V_in)
+
+def tau_net(network, freq=None, Z_s=None, Z_l=None, V_in=None, override:dict=None):
+    """ Calculates tau for the network. freq, Z_s, Z_l and override replace
+    the network's own values if given, as in P_net(). V_in is accepted so the
+    same arguments can be passed to both, but does not affect tau.
+    """
+
+    if freq is None:
+        freq = network.freq
+    if Z_s is None:
+        Z_s = network.Z_s
+    if Z_l is None:
+        Z_l = network.Z_l
+
+    Z_s = _impedance(Z_s, freq)
+    Z_l = _impedance(Z_l, freq)
+
+    return tau_load(Z_l, Z_out(network.circ, freq, Z_s, override))
+
+def transmission_load(Z_l:complex, Z_s:complex):
+    """ Calculates the fraction of the available source power delivered to a
+    load Z_l driven from an impedance Z_s, 4*Re(Z_l)*Re(Z_s)/|Z_l + Z_s|^2.
+    This is 1 at a conjugate match, and equals |tau| when both impedances
+    are real.
+    """
+
+    S = Z_l + Z_s
+    return 4*np.real(Z_l)*np.real(Z_s)/(S.real*S.real + S.imag*S.imag)
+
+def transmission_net(network, freq=None, Z_s=None, Z_l=None, override:dict=None):
+    """ Calculates transmission_load() for the network, with the same
+    optional replacements as tau_net().
+    """
+
+    if freq is None:
+        freq = network.freq
+    if Z_s is None:
+        Z_s = network.Z_s
+    if Z_l is None:
+        Z_l = network.Z_l
+
+    Z_s = _impedance(Z_s, freq)
+    Z_l = _impedance(Z_l, freq)
+
+    return transmission_load(Z_l, Z_out(network.circ, freq, Z_s, override))
+
+def gradient_net(network, freq=None):
+    """ Calculates the exact derivatives of tau and P_load with respect to
+    every parameter of the network in one pass through the ladder (see
+    CompiledCircuit.grad_Z_out()), rather than one finite difference per
+    parameter as in sensitivity().
+
+    Returns a tuple (params, dT, dP). params is a list of parameter strings
+    in the format accepted by sensitivity(): "<element> R", "<element> L" and
+    "<element> C" for every element, followed by "Z_s", "Z_l", "freq" and
+    "Vin". dT and dP are complex numpy arrays of dtau/dp and dP_load/dp with
+    one row per parameter (rows are arrays if freq is an array). The "freq"
+    row includes the slope of a tabulated Z_s or Z_l (see
+    TabulatedImpedance.slope()). freq replaces network.freq if given.
+    Returns None if the circuit is invalid.
+    """
+
+    cc = compile_circuit(network.circ)
+    if cc is None:
+        return None
+
+    if freq is None:
+        freq = network.freq
+
+    Zout, dR, dL, dC, dZs, dZf = cc.grad_Z_out(freq, _impedance(network.Z_s, freq))
+    shape = np.shape(dZs)
+
+    params = []
+    for name in cc.names:
+        params.extend([f"{name} R", f"{name} L", f"{name} C"])
+    params.extend(["Z_s", "Z_l", "freq", "Vin"])
+
+    #Rows ordered R, L, C for each element in turn
+    dZ = np.stack([dR, dL, dC], axis=1).reshape((3*len(cc),) + shape)
+
+    Z_l = _impedance(network.Z_l, freq)
+    V_in = network.V_in
+    S = Z_l + Zout
+    S3 = S*S*S
+
+    #tau = 4*Zl*Z/(Zl + Z)^2 and P = Vin^2*Re(Zl)/(Zl + Z)^2
+    dT_dZ = 4*Z_l*(Z_l - Zout)/S3
+    dT_dZl = 4*Zout*(Zout - Z_l)/S3
+    dP_dZ = -2*V_in**2*Z_l.real/S3
+    dP_dZl = V_in**2/(S*S) + dP_dZ
+    dP_dV = 2*V_in*Z_l.real/(S*S)
+
+    #A tabulated Z_s or Z_l moves with freq along its slope
+    dZs_df = _impedance_slope(network.Z_s, freq)
+    dZl_df = _impedance_slope(network.Z_l, freq)
+    dZf = dZf + dZs*dZs_df
+
+    dT = list(dT_dZ*dZ) + [dT_dZ*dZs, dT_dZl, dT_dZ*dZf + dT_dZl*dZl_df, 0]
+    dP = list(dP_dZ*dZ) + [dP_dZ*dZs, dP_dZl, dP_dZ*dZf + dP_dZl*dZl_df, dP_dV]
+
+    dT = np.array([np.broadcast_to(d, shape) for d in dT], dtype=complex)
+    dP = np.array([np.broadcast_to(d, shape) for d in dP], dtype=complex)
+
+    return (params, dT, dP)
+
+def hessian_net(network, freq=None):
+    """ Calculates the exact first and second derivatives of tau with
+    respect to every parameter of the network, including the cross terms
+    between parameters, in one batched pass (see
+    CompiledCircuit.hess_Z_out()). freq replaces network.freq if given, and
+    may be an array.
+
+    Returns a tuple (params, dT, d2T). params is the same list as in
+    gradient_net(). dT has one row per parameter and d2T one row and column
+    per pair of parameters, each shaped like freq. The "Vin" entries are
+    zero. The "freq" entries include the slope of a tabulated Z_s or Z_l
+    (see TabulatedImpedance.slope()), which is linear between table points.
+    Returns None if the circuit is invalid.
+    """
+
+    cc = compile_circuit(network.circ)
+    if cc is None:
+        return None
+
+    if freq is None:
+        freq = network.freq
+
+    Zout, grad, hess = cc.hess_Z_out(freq, _impedance(network.Z_s, freq))
+    shape = np.shape(Zout)
+    n = len(cc)
+
+    params = []
+    for name in cc.names:
+        params.extend([f"{name} R", f"{name} L", f"{name} C"])
+    params.extend(["Z_s", "Z_l", "freq", "Vin"])
+
+    #Z_out does not depend on Z_l or Vin
+    P = 3*n + 4
+    pos = list(range(3*n + 1)) + [3*n + 2]
+    dZ = np.zeros((P,) + shape, dtype=complex)
+    d2Z = np.zeros((P, P) + shape, dtype=complex)
+    dZ[pos] = grad
+    d2Z[np.ix_(pos, pos)] = hess
+    l = 3*n + 1
+
+    #tau = 4*Zl*Z/(Zl + Z)^2 and its partial derivatives
+    Z_l = _impedance(network.Z_l, freq)
+    Z = Zout
+    S = Z_l + Z
+    S3 = S*S*S
+    S4 = S3*S
+    T_Z = 4*Z_l*(Z_l - Z)/S3
+    T_l = 4*Z*(Z - Z_l)/S3
+    T_ZZ = -8*Z_l*(2*Z_l - Z)/S4
+    T_ll = -8*Z*(2*Z - Z_l)/S4
+    T_Zl = 4*(4*Z_l*Z - Z_l*Z_l - Z*Z)/S4
+
+    dT = T_Z*dZ
+    dT[l] += T_l
+
+    d2T = T_Z*d2Z + T_ZZ*dZ[:, np.newaxis]*dZ[np.newaxis, :]
+    d2T[l] += T_Zl*dZ
+    d2T[:, l] += T_Zl*dZ
+    d2T[l, l] += T_ll
+
+    #A tabulated Z_s or Z_l moves with freq along its slope, so the freq
+    #direction is e_freq + dZs/df*e_Zs + dZl/df*e_Zl. The tables are linear
+    #between points, so there is no second derivative of their own
+    f = 3*n + 2
+    a = _impedance_slope(network.Z_s, freq)
+    b = _impedance_slope(network.Z_l, freq)
+    dT[f] += a*dT[3*n] + b*dT[l]
+    d2T[f] += a*d2T[3*n] + b*d2T[l]
+    d2T[:, f] += a*d2T[:, 3*n] + b*d2T[:, l]
+
+    return (params, dT, d2T)
+
+def predict_tau(network, changes:dict, freq=None, pcnt:bool=False, derivs=None):
+    """ Predicts tau when each parameter in changes (see sensitivity() for
+    the format) is increased by the given amount, from the quadratic
+    expansion about the nominal network, without evaluating the changed
+    network. With pcnt=True the amounts are percentages of the current
+    values, as in sens_pcnt(). freq replaces network.freq if given.
+
+    derivs is the result of hessian_net() at the same frequencies, which can
+    be passed in so many predictions share one calculation.
+
+    Returns a tuple (tau1, tau2) of the first and second order predictions,
+    or None if a parameter is invalid.
+    """
+
+    if freq is None:
+        freq = network.freq
+
+    if derivs is None:
+        derivs = hessian_net(network, freq)
+        if derivs is None:
+            return None
+    params, dT, d2T = derivs
+    index = {p.upper(): i for i, p in enumerate(params)}
+
+    dp = np.zeros(dT.shape[:1] + np.shape(freq), dtype=complex)
+    for param, val in changes.items():
+        key = " ".join(param.split()).upper()
+        if key not in index:
+            print(f"ERROR: Invalid parameter '{param}'.")
+            return None
+        if pcnt:
+            p0 = _get_param(network, param, freq)
+            if p0 is None:
+                return None
+            val = p0*val/100.0
+        dp[index[key]] += val
+
+    t0 = tau_net(network, freq)
+    first = np.sum(dT*dp, axis=0)
+    second = np.sum(np.sum(d2T*dp[np.newaxis, :], axis=1)*dp, axis=0)
+
+    return (t0 + first, t0 + first + second/2)
+
+def sens_pcnt(network, param:str, val=1, freq=None):
+    """
+    Same as sens_percent() except val is in percent-100
+    ie. val=1 -> multiplier of 1.01, val=0 -> multiplier 1, val 50 -> multiplier 1.5
+
+    has abbreviated return
+
+    val=None chooses the step automatically (see fd_derivative())
+    """
+
+    if val is None:
+        deriv = fd_derivative(network, param, freq)
+        return None if deriv is None else _cabs(deriv[0])
+
+    p0 = _get_param(network, param, freq)
+    if p0 is None:
+        return None
+
+    deriv = sensitivity(network, param, _pcnt_step(p0, val), True, freq)
+    if deriv is None:
+        return None
+
+    return _cabs(deriv[0])
+
+def _pcnt_step(p0, val):
+    """ Returns the change in a parameter of value p0 for a val percent
+    perturbation. A complex p0 (eg. Z_l) is scaled along its own phase.
+    """
+
+    return p0*(abs(val)/100.0)
+
+def sens_percent(network, param:str, val, freq=None):
+    """
+    val: multiplier (2 -> +100%, 1 -> no change, etc)
+    freq replaces network.freq if given (see sensitivity())
+    """
+
+
+    if type(val) != float and type(val) != complex and type(val) != int and not isinstance(val, (np.ndarray, np.number)):
+        print("ERROR: Value must be float, complex, int or numpy array type.")
+        return None
+
+    p0 = _get_param(network, param, freq)
+    if p0 is None:
+        return None
+    dv = p0*abs(val-1)
+
+    return sensitivity(network, param, dv, True, freq)
+
+def _find_element(circ:list, element_name:str):
+    """ Returns the index of the last component in a circuit list (or
+    CompiledCircuit) named element_name (case insensitive), or None if it is
+    not found.
+    """
+
+    stats = _stats.get()
+    if stats is not None:
+        stats.add("find_element")
+
+    if isinstance(circ, CompiledCircuit):
+        return circ.index.get(element_name.upper())
+
+    idx = None
+    for i, t in enumerate(circ):
+        if t[0].name.upper() == element_name.upper():
+            idx = i
+
+    return idx
+
+def _element_values(circ:list, idx:int):
+    """ Returns the Values of element idx of a circuit list or CompiledCircuit
+    """
+
+    if isinstance(circ, CompiledCircuit):
+        return Values(circ.R[idx], circ.L[idx], circ.C[idx])
+
+    return circ[idx][0].val
+
+def _get_param(network, param:str, freq=None):
+    """ Returns the current value of the network parameter named by 'param'
+    (see sensitivity() for format), or None if it is invalid. freq replaces
+    network.freq if given.
+    """
+
+    if freq is None:
+        freq = network.freq
+
+    if param.upper() == "FREQ":
+        return freq
+    elif param.upper() == "Z_L":
+        return _impedance(network.Z_l, freq)
+    elif param.upper() == "Z_S":
+        return _impedance(network.Z_s, freq)
+    elif param.upper() == "VIN":
+        return network.V_in
+
+    words = param.split()
+    if len(words) < 2:
+        print("ERROR: Invalid parameter. Fewer than two words.")
+        return None
+    element_name = words[0]
+    val_name = words[1]
+
+    idx = _find_element(network.circ, element_name)
+
+    if idx == None:
+        print("ERROR: Element not found.")
+        return None
+    v = _element_values(network.circ, idx)
+
+    if val_name.upper() == "C":
+        return v.C
+    elif val_name.upper() == "L":
+        return v.L
+    elif val_name.upper() == "R":
+        return v.R
+
+    print(f"ERROR: Invalid element parameter '{val_name}'.")
+    return None
+
+def _perturbation(network, param:str, val, freq=None):
+    """ Describes the network with the parameter named by 'param' (see
+    sensitivity() for format) increased by val, without copying it. freq
+    replaces network.freq if given.
+
+    Returns a dict of keyword arguments for tau_net() and P_net() which
+    evaluate the perturbed network, or None if the parameter is invalid.
+    """
+
+    stats = _stats.get()
+    if stats is not None:
+        stats.add("perturbation")
+
+    if freq is None:
+        freq = network.freq
+
+    if param.upper() == "FREQ":
+        return {"freq": freq + val}
+    elif param.upper() == "Z_L":
+        return {"Z_l": _impedance(network.Z_l, freq) + val}
+    elif param.upper() == "Z_S":
+        return {"Z_s": _impedance(network.Z_s, freq) + val}
+    elif param.upper() == "VIN":
+        return {"V_in": network.V_in + val}
+
+    words = param.split()
+    if len(words) < 2:
+        print("ERROR: Invalid parameter. Fewer than two words.")
+        return None
+    element_name = words[0]
+    val_name = words[1]
+
+    idx = _find_element(network.circ, element_name)
+
+    if idx == None:
+        print("ERROR: Element not found.")
+        return None
+    v = _element_values(network.circ, idx)
+
+    if val_name.upper() == "C":
+        new_val = Values(v.R, v.L, v.C + val)
+    elif val_name.upper() == "L":
+        new_val = Values(v.R, v.L + val, v.C)
+    elif val_name.upper() == "R":
+        new_val = Values(v.R + val, v.L, v.C)
+    else:
+        print(f"ERROR: Invalid element parameter '{val_name}'.")
+        return None
+
+    return {"override": {idx: new_val}}
+
+def sensitivity(network, param:str, val, use_tau=False, freq=None):
+    """ Calculates the change in P_load (or tau if use_tau is True) when the
+    parameter 'param' is increased by val.
+
+    param is "freq", "Z_l", "Z_s", "Vin", or "<element name> <R, L or C>".
+
+    freq (a float or array) replaces network.freq if given. The network is
+    never modified, so the same one can be evaluated from several threads.
+
+    Returns a tuple (dP/dp, dP, P0, P1) (or the same for tau).
+    """
+
+    if type(val) != float and type(val) != complex and type(val) != int and not isinstance(val, (np.ndarray, np.number)):
+        print("ERROR: Value must be float, complex, int or numpy array type.")
+        return None
+
+    perturbed = _perturbation(network, param, val, freq)
+    if perturbed is None:
+        return None
+    perturbed = {"freq": freq, **perturbed}
+
+    if use_tau:
+        t0 = tau_net(network, freq)
+        t1 = tau_net(network, **perturbed)
+        dT = t1-t0
+        dTdV = _cdiv(dT, val)
+        return (dTdV, dT, t0, t1)
+
+    P0 = P_net(network, freq)
+    P1 = P_net(network, **perturbed)
+
+    dP = P1-P0
+
+    dPdV = _cdiv(dP, val)
+
+    return (dPdV, dP, P0, P1)
+
+def _fd_scale(network, cc, param:str, freq):
+    """ Returns the size of 'param' used to choose finite difference steps:
+    its magnitude, or for a zero value, the size that gives an impedance
+    comparable to the source (so zero parasitics still get sensible steps).
+    Element values give a float, other parameters an array shaped like freq.
+    """
+
+    f = np.asarray(freq, dtype=float)
+    Z0 = np.abs(_impedance(network.Z_s, f))
+    Z0 = np.where(Z0 > 0, Z0, 50.0)
+    w = 2*3.14159*np.where(f > 0, f, 1.0)
+
+    key = param.upper()
+    if key == "FREQ":
+        return np.where(f > 0, f, 1.0)
+    elif key == "Z_S" or key == "Z_L":
+        p = np.abs(_get_param(network, param, f))*np.ones(f.shape)
+        return np.where(p > 0, p, Z0)
+    elif key == "VIN":
+        return np.full(f.shape, abs(network.V_in) if network.V_in != 0 else 1.0)
+
+    #Element values share one step across frequencies
+    words = param.split()
+    v = _element_values(cc, _find_element(cc, words[0]))
+    Z0 = float(np.median(Z0))
+    w = float(np.median(w))
+    if words[1].upper() == "R":
+        p, floor = v.R, Z0
+    elif words[1].upper() == "L":
+        p, floor = v.L, Z0/w
+    else:
+        p, floor = v.C, 1/(w*Z0)
+
+    return abs(p) if p != 0 else floor
+
+def _fd_batch(network, cc, param:str, h, freq, use_tau:bool):
+    """ Evaluates tau (or P_load if use_tau is False) with 'param' increased
+    by each step in h, all in one pass through the ladder. h has one row per
+    step and is a 1D array for element values, or broadcasts against freq
+    otherwise. Returns an array of shape (len(h), *freq.shape).
+    """
+
+    f = np.asarray(freq, dtype=float)
+    Z_s = _impedance(network.Z_s, f)
+    Z_l = _impedance(network.Z_l, f)
+    V_in = network.V_in
+    R, L, C = cc.R, cc.L, cc.C
+
+    key = param.upper()
+    if key == "FREQ":
+        f = f + h
+        Z_s = _impedance(network.Z_s, f)
+        Z_l = _impedance(network.Z_l, f)
+    elif key == "Z_S":
+        Z_s = Z_s + h
+    elif key == "Z_L":
+        Z_l = Z_l + h
+    elif key == "VIN":
+        V_in = V_in + h
+    else:
+        words = param.split()
+        idx = _find_element(cc, words[0])
+        R, L, C = [np.repeat(x[:, np.newaxis], len(h), axis=1) for x in (R, L, C)]
+        {"R": R, "L": L, "C": C}[words[1].upper()][idx] += h
+
+    Zout = cc.Z_out(f, Z_s, R, L, C)
+    shape = (len(h),) + np.shape(freq)
+
+    if use_tau:
+        return np.broadcast_to(tau_load(Z_l, Zout), shape)
+
+    return np.broadcast_to(P_load(Z_l, Zout, V_in), shape)
+
+def fd_derivative(network, param:str, freq=None, use_tau:bool=True, rel_step:float=0.01, n_steps:int=8, factor:float=2):
+    """ Calculates dtau/dp (or dP_load/dp if use_tau is False) by central
+    differences, without the caller choosing a step. param is as in
+    sensitivity().
+
+    The first step is rel_step times the size of the parameter (see
+    _fd_scale()) and each following step is smaller by factor. All
+    2*n_steps perturbed networks are evaluated in one batch, the
+    differences are Richardson extrapolated, and at each frequency the
+    entry of the table with the smallest error estimate is kept (Ridders'
+    method). A tabulated Z_s or Z_l is interpolated at the perturbed
+    frequencies, so the freq derivative includes the slope of the table.
+
+    freq replaces network.freq if given. Returns a tuple (deriv, err) of the
+    derivative and an estimate of its absolute error, or None if the
+    parameter is invalid.
+    """
+
+    if freq is None:
+        freq = network.freq
+
+    cc = compile_circuit(network.circ)
+    if cc is None:
+        return None
+    if _get_param(network, param, freq) is None:
+        return None
+    if n_steps < 1 or factor <= 1:
+        print("ERROR: Need n_steps >= 1 and factor > 1.")
+        return None
+
+    f = np.asarray(freq, dtype=float)
+    steps = rel_step*float(factor)**-np.arange(n_steps)
+    scale = _fd_scale(network, cc, param, f)
+    h = steps.reshape((n_steps,) + (1,)*np.ndim(scale))*scale
+    F = _fd_batch(network, cc, param, np.concatenate([h, -h]), f, use_tau)
+    if np.ndim(scale) == 0:
+        h = h.reshape((n_steps,) + (1,)*f.ndim)
+    D = (F[:n_steps] - F[n_steps:])/(2*h)
+
+    #Each row of the table extrapolates the previous one to a smaller step
+    deriv = D[0]
+    err = np.full(f.shape, np.inf)
+    prev = [D[0]]
+    for i in range(1, n_steps):
+        row = [D[i]]
+        for j in range(1, i + 1):
+            k = float(factor)**(2*j)
+            row.append((k*row[j - 1] - prev[j - 1])/(k - 1))
+            e = np.maximum(np.abs(row[j] - row[j - 1]), np.abs(row[j] - prev[j - 1]))
+            better = e < err
+            deriv = np.where(better, row[j], deriv)
+            err = np.where(better, e, err)
+        prev = row
+
+    return (deriv[()], err[()])
+
+def sensitivity_matrix(network, params:list, freqs, quantity:str="dtau", val=1, abs_val=None):
+    """ Calculates the sensitivity of the network to every parameter in params
+    at every frequency in freqs, in one call.
+
+    quantity selects what is returned:
+        "dtau"    - change in tau when each parameter is increased by val
+                    percent, or by abs_val if it is given (as in
+                    get_spectrum_norm()). tau at the nominal values and the
+                    ladder stages before and after each perturbed element
+                    are only calculated once (see LadderCache). A zero step
+                    gives exactly 0. Otherwise rows agree with
+                    get_spectrum_norm() to within rounding of tau (about
+                    1e-15*|tau|), which also bounds the accuracy of either
+                    for very small steps.
+        "dtau_dp" - exact derivative dtau/dp, from a single gradient_net()
+                    pass shared by all parameters
+        "dP_dp"   - exact derivative dP_load/dp, as for "dtau_dp"
+
+    Returns a complex numpy array with one row per parameter and one column
+    per frequency, or None if a parameter is invalid.
+    """
+
+    freqs = np.asarray(freqs, dtype=float)
+
+    if quantity.upper() == "DTAU":
+
+        cc = compile_circuit(network.circ)
+        if cc is None:
+            return None
+
+        #Look elements up by name in the compiled circuit, not the list
+        compiled = Network(cc, network.Z_s, network.Z_l, network.freq)
+        compiled.V_in = network.V_in
+        network = compiled
+
+        #Element perturbations fold one stage onto the cached ladder
+        Z_l = _impedance(network.Z_l, freqs)
+        cache = LadderCache(cc, freqs, _impedance(network.Z_s, freqs))
+        t0 = tau_load(Z_l, cache.Z_out())
+
+        rows = []
+        for param in params:
+
+            if abs_val is not None:
+                dv = abs_val
+            else:
+                p0 = _get_param(network, param, freqs)
+                if p0 is None:
+                    return None
+                dv = _pcnt_step(p0, val)
+
+            perturbed = _perturbation(network, param, dv, freqs)
+            if perturbed is None:
+                return None
+
+            if np.all(dv == 0):
+                rows.append(np.zeros(freqs.shape, dtype=complex))
+            elif "override" in perturbed:
+                #The nominal tau goes through the same suffix transfer as the
+                #perturbed one, so their rounding errors cancel in the change
+                k, v = list(perturbed["override"].items())[0]
+                t0_k = tau_load(Z_l, cache.Z_out_with(k))
+                rows.append(tau_load(Z_l, cache.Z_out_with(k, v.R, v.L, v.C)) - t0_k)
+            else:
+                rows.append(tau_net(network, **{"freq": freqs, **perturbed}) - t0)
+
+    elif quantity.upper() == "DTAU_DP" or quantity.upper() == "DP_DP":
+
+        grad = gradient_net(network, freqs)
+        if grad is None:
+            return None
+        names, dT, dP = grad
+        index = {n.upper(): i for i, n in enumerate(names)}
+
+        rows = []
+        for param in params:
+            key = " ".join(param.split()).upper()
+            if key not in index:
+                print(f"ERROR: Invalid parameter '{param}'.")
+                return None
+            if quantity.upper() == "DTAU_DP":
+                rows.append(dT[index[key]])
+            else:
+                rows.append(dP[index[key]])
+
+    else:
+        print(f"ERROR: Unrecognized quantity '{quantity}'. Options are 'dtau', 'dtau_dp' and 'dP_dp'.")
+        return None
+
+    return np.array(rows, dtype=complex).reshape(len(params), np.size(freqs))
+
+def get_spectrum_pcnt(network, param, fs, val=1):
+    """ Calculates sens_pcnt() at each frequency in fs. The whole frequency
+    array is evaluated at once and a numpy array is returned, or None if
+    param is invalid.
+    """
+
+    stats = _stats.get()
+    if stats is not None:
+        t0 = time.perf_counter()
+
+    sens = sens_pcnt(network, param, val, np.asarray(fs, dtype=float))
+
+    if stats is not None:
+        stats.add("spectrum", time.perf_counter() - t0)
+
+    return sens
+
+def get_spectrum_val(network, param, fs, val=None):
+    """ Calculates |dtau/dp| for an absolute perturbation 'val' at each
+    frequency in fs. Returns a numpy array, or None if param is invalid. If
+    val is None the steps are chosen automatically at each frequency (see
+    fd_derivative()).
+    """
+
+    stats = _stats.get()
+    if stats is not None:
+        t0 = time.perf_counter()
+
+    fs = np.asarray(fs, dtype=float)
+    if val is None:
+        deriv = fd_derivative(network, param, fs)
+    else:
+        deriv = sensitivity(network, param, val, True, fs)
+    if deriv is None:
+        return None
+    sens = _cabs(deriv[0])
+
+    if stats is not None:
+        stats.add("spectrum", time.perf_counter() - t0)
+
+    return sens
+
+def get_spectrum_norm(network, param, fs, val=1, abs_val=None):
+    """ Calculates |dtau| for a perturbation of 'val' percent (or of abs_val
+    if it is specified) at each frequency in fs. Returns a numpy array, or
+    None if param is invalid.
+    """
+
+    stats = _stats.get()
+    if stats is not None:
+        t0 = time.perf_counter()
+
+    fs = np.asarray(fs, dtype=float)
+    if abs_val is not None:
+        deriv = sensitivity(network, param, abs_val, use_tau=True, freq=fs)
+    else:
+        p0 = _get_param(network, param, fs)
+        if p0 is None:
+            return None
+        deriv = sensitivity(network, param, _pcnt_step(p0, val), use_tau=True, freq=fs)
+    if deriv is None:
+        return None
+    sens = _cabs(deriv[1])
+
+    if stats is not None:
+        stats.add("spectrum", time.perf_counter() - t0)
+
+    return sens
+
+def get_spectrum_adaptive(network, param, f_min:float, f_max:float, spectrum=get_spectrum_pcnt, tol:float=0.01, n_start:int=17, max_points:int=1000, **kwargs):
+    """ Evaluates one of the get_spectrum_*() functions (spectrum) from f_min
+    to f_max on an adaptive grid rather than a fixed one. kwargs are passed on
+    to spectrum (eg. val=.1).
+
+    The sweep starts from n_start log spaced points. Every interval is split
+    at its (log) midpoint, and is split again while the value there differs
+    from the linear interpolation of its end points by more than tol times
+    the largest value seen. All midpoints of a pass are evaluated in one
+    call. Refinement stops when no interval changes by more than the
+    tolerance or max_points is reached, in which case the intervals with the
+    largest error are split first.
+
+    Features narrower than the starting grid spacing can be missed, so
+    n_start should resolve the widest expected resonance.
+
+    Returns a tuple (freqs, values) of numpy arrays in increasing frequency,
+    or None if the frequencies or param are invalid.
+    """
+
+    if f_min <= 0 or f_max <= f_min:
+        print("ERROR: Frequencies must satisfy 0 < f_min < f_max.")
+        return None
+
+    x = np.linspace(np.log10(f_min), np.log10(f_max), max(n_start, 2))
+    y = spectrum(network, param, 10**x, **kwargs)
+    if y is None:
+        return None
+
+    #Error estimate of each interval. Unsplit intervals are inf, and
+    #intervals which met the tolerance are 0.
+    err = np.full(len(x)-1, np.inf)
+
+    while len(x) < max_points:
+
+        idx = np.flatnonzero(err > 0)
+        if len(idx) == 0:
+            break
+        if len(x) + len(idx) > max_points:
+            idx = np.sort(idx[np.argsort(-err[idx], kind='stable')[:max_points - len(x)]])
+
+        xm = (x[idx] + x[idx+1])/2
+        ym = spectrum(network, param, 10**xm, **kwargs)
+
+        e = np.abs(ym - (y[idx] + y[idx+1])/2)
+        scale = max(np.nanmax(np.abs(y), initial=0), np.nanmax(np.abs(ym), initial=0))
+        e = np.where(e > tol*scale, e, 0)
+
+        #Each split interval becomes two, both inheriting the new estimate
+        new_err = np.insert(err, idx+1, 0)
+        pos = idx + np.arange(len(idx))
+        new_err[pos] = e
+        new_err[pos+1] = e
+
+        x = np.insert(x, idx+1, xm)
+        y = np.insert(y, idx+1, ym)
+        err = new_err
+
+    return (10**x, y)
+
+def freq_chunks(f_min:float, f_max:float, n:int, chunk_size:int=65536, log:bool=True):
+    """ Generates the frequencies of an n point sweep from f_min to f_max
+    (log spaced unless log=False) as numpy arrays of at most chunk_size
+    points, without holding the whole sweep in memory.
+    """
+
+    a, b = (np.log10(f_min), np.log10(f_max)) if log else (f_min, f_max)
+    for start in range(0, n, chunk_size):
+        i = np.arange(start, min(start + chunk_size, n))
+        x = a + (b - a)*i/max(n - 1, 1)
+        yield 10**x if log else x
+
+def spectrum_chunks(network, params, fs, spectrum=get_spectrum_pcnt, chunk_size:int=65536, **kwargs):
+    """ Generator version of the get_spectrum_*() functions (spectrum), for
+    sweeps too long to hold in memory. kwargs are passed on to spectrum.
+
+    fs is either an array of frequencies, which is evaluated chunk_size
+    points at a time, or an iterable of frequency arrays such as
+    freq_chunks(). params is a parameter string or a list of them.
+
+    Yields tuples (freqs, values) for each chunk. values has one row per
+    parameter if params is a list.
+    """
+
+    if isinstance(fs, (np.ndarray, list, tuple)):
+        fs = np.asarray(fs, dtype=float)
+        chunks = (fs[i:i+chunk_size] for i in range(0, len(fs), chunk_size))
+    else:
+        chunks = fs
+
+    for f in chunks:
+        if isinstance(params, str):
+            yield (f, spectrum(network, params, f, **kwargs))
+        else:
+            yield (f, np.array([spectrum(network, p, f, **kwargs) for p in params]))
+
+def spectrum_threaded(network, params, fs, spectrum=get_spectrum_pcnt, workers:int=None, chunk_size:int=None, **kwargs):
+    """ Evaluates one of the get_spectrum_*() functions (spectrum) over the
+    frequencies fs on a pool of threads. kwargs are passed on to spectrum.
+
+    fs is split into chunks of chunk_size points (default an equal share per
+    worker) which are evaluated concurrently on the same network. This only
+    pays off for long sweeps, where most of the time is spent in numpy
+    operations that release the GIL. workers defaults to the number of CPUs.
+
+    Returns the same as spectrum(network, params, fs), with one row per
+    parameter if params is a list.
+    """
+
+    fs = np.asarray(fs, dtype=float)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = max(-(-len(fs)//workers), 1)
+
+    def evaluate(f):
+        if isinstance(params, str):
+            return spectrum(network, params, f, **kwargs)
+        return np.array([spectrum(network, p, f, **kwargs) for p in params])
+
+    chunks = [fs[i:i+chunk_size] for i in range(0, len(fs), chunk_size)]
+    if len(chunks) <= 1 or workers == 1:
+        return evaluate(fs)
+
+    #Each chunk runs in a copy of the caller's context, so an open profile()
+    #collects the workers' events
+    contexts = [contextvars.copy_context() for chunk in chunks]
+    with ThreadPoolExecutor(workers) as pool:
+        values = list(pool.map(lambda ctx, f: ctx.run(evaluate, f), contexts, chunks))
+
+    return np.concatenate(values, axis=-1)
+
+def _shared_pack(arrays:dict):
+    """ Copies the numpy arrays in a dict into one new block of shared
+    memory. Returns a tuple (shm, layout), where layout is a picklable list
+    of (key, dtype, shape, offset) for _shared_unpack().
+    """
+
+    layout = []
+    size = 0
+    for key, a in arrays.items():
+        size = -(-size//16)*16
+        layout.append((key, a.dtype.str, a.shape, size))
+        size += a.nbytes
+
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for key, dtype, shape, offset in layout:
+        np.ndarray(shape, dtype, shm.buf, offset)[...] = arrays[key]
+
+    return (shm, layout)
+
+def _shared_unpack(shm, layout:list):
+    """ Returns a dict of numpy arrays viewing the block written by
+    _shared_pack()
+    """
+
+    return {key: np.ndarray(shape, dtype, shm.buf, offset) for key, dtype, shape, offset in layout}
+
+#Set in each run_batch() worker process by _batch_init()
+_batch_worker = None
+
+def _batch_init(name:str, layout:list, points:list, params:list, spectrum, kwargs:dict):
+    """ Attaches a run_batch() worker to the shared circuit and result arrays """
+
+    global _batch_worker
+
+    shm = shared_memory.SharedMemory(name=name)
+    a = _shared_unpack(shm, layout)
+    batch = NetlistBatch(a["R"], a["L"], a["C"], a["types"], a["series"], a["names"], a["offsets"], a["nets"])
+    _batch_worker = (shm, batch, a["out"], points, params, spectrum, kwargs)
+
+def _batch_run(start:int, stop:int):
+    """ Evaluates circuits start to stop of the shared batch at every
+    operating point, writing into the shared result array.
+    """
+
+    shm, batch, out, points, params, spectrum, kwargs = _batch_worker
+
+    for i in range(start, stop):
+        cc = batch[i]
+        for j, (Z_s, Z_l, fs) in enumerate(points):
+            net = Network(cc, Z_s, Z_l, fs)
+            for k, param in enumerate(params):
+
+                #Elements missing from this circuit are left as nan
+                words = param.split()
+                if len(words) > 1 and words[0].upper() not in cc.index:
+                    continue
+
+                out[i, j, k] = spectrum(net, param, fs, **kwargs)
+
+    return stop - start
+
+def run_batch(batch, points:list, params, spectrum=get_spectrum_pcnt, workers:int=None, chunk_size:int=None, **kwargs):
+    """ Evaluates one of the get_spectrum_*() functions (spectrum) for every
+    circuit of a NetlistBatch (or a source accepted by load_netlists()) at
+    every operating point, spread across a pool of processes. kwargs are
+    passed on to spectrum.
+
+    points is a list of (Z_s, Z_l, fs) tuples. fs is a frequency or array of
+    frequencies, and must have the same length for every point. params is a
+    parameter string or list of them; element parameters of elements a
+    circuit does not have give nan.
+
+    The packed circuit arrays and the result array are placed in shared
+    memory, so each worker receives only the name of the block and writes
+    its results in place. Circuits are handed out chunk_size at a time
+    (default four chunks per worker). workers defaults to the number of
+    CPUs; with workers=1 everything runs in this process.
+
+    Returns a numpy array indexed [circuit, point, param, freq] (without the
+    param axis if params is a string).
+    """
+
+    global _batch_worker
+
+    if not isinstance(batch, NetlistBatch):
+        batch = load_netlists(batch)
+
+    single = isinstance(params, str)
+    if single:
+        params = [params]
+
+    points = [(Z_s, Z_l, np.atleast_1d(np.asarray(fs, dtype=float))) for Z_s, Z_l, fs in points]
+    n_f = {len(fs) for Z_s, Z_l, fs in points}
+    if len(n_f) > 1:
+        print("ERROR: Every operating point must have the same number of frequencies.")
+        return None
+    n_f = n_f.pop() if n_f else 0
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = max(-(-len(batch)//(4*workers)), 1)
+
+    arrays = {"R": batch.R, "L": batch.L, "C": batch.C, "types": batch.types, "series": batch.series, "names": batch.names, "offsets": batch.offsets, "nets": batch.nets,
+              "out": np.full((len(batch), len(points), len(params), n_f), np.nan)}
+    shm, layout = _shared_pack(arrays)
+    args = (shm.name, layout, points, params, spectrum, kwargs)
+    chunks = [(i, min(i + chunk_size, len(batch))) for i in range(0, len(batch), chunk_size)]
+
+    try:
+        if workers == 1:
+            _batch_init(*args)
+            try:
+                for start, stop in chunks:
+                    _batch_run(start, stop)
+            finally:
+                _batch_worker[0].close()
+                _batch_worker = None
+        elif len(chunks) > 0:
+            with ProcessPoolExecutor(workers, initializer=_batch_init, initargs=args) as pool:
+                list(pool.map(_batch_run, *zip(*chunks)))
+
+        out = _shared_unpack(shm, layout)["out"].copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return out[:, :, 0] if single else out
+
+def reduce_argmax(stream):
+    """ Consumes a spectrum_chunks() stream. Returns a tuple (freq, value)
+    of the largest value (one per parameter for a list of parameters).
+    nan values are ignored.
+    """
+
+    best_f = None
+    best = None
+    for f, v in stream:
+        v = np.where(np.isnan(v), -np.inf, v)
+        i = np.argmax(v, axis=-1)
+        fi = f[i]
+        vi = np.take_along_axis(v, np.expand_dims(i, -1), axis=-1)[..., 0]
+        if best is None:
+            best_f, best = fi, vi
+        else:
+            better = vi > best
+            best_f = np.where(better, fi, best_f)
+            best = np.where(better, vi, best)
+
+    return (best_f, best)
+
+def reduce_max(stream):
+    """ Consumes a spectrum_chunks() stream and returns the largest value """
+
+    return reduce_argmax(stream)[1]
+
+def reduce_band_average(stream, f_lo:float, f_hi:float):
+    """ Consumes a spectrum_chunks() stream and returns the average value
+    between f_lo and f_hi, integrated over frequency by the trapezoid rule.
+    Chunks must be in increasing frequency.
+    """
+
+    total = 0
+    width = 0
+    last = None
+    for f, v in stream:
+        band = (f >= f_lo) & (f <= f_hi)
+        f = f[band]
+        v = v[..., band]
+        if len(f) == 0:
+            continue
+
+        #Join onto the last point of the previous chunk
+        if last is not None:
+            f = np.concatenate(([last[0]], f))
+            v = np.concatenate((last[1][..., np.newaxis], v), axis=-1)
+
+        df = np.diff(f)
+        total = total + np.sum(df*(v[..., 1:] + v[..., :-1])/2, axis=-1)
+        width += np.sum(df)
+        last = (f[-1], v[..., -1])
+
+    if width == 0:
+        print("ERROR: Fewer than two frequencies in band.")
+        return None
+
+    return total/width
+
+def reduce_histogram(stream, bins):
+    """ Consumes a spectrum_chunks() stream of a single parameter and returns
+    a tuple (counts, edges) as np.histogram() would. bins is the array of bin
+    edges, which must be given up front as the data range is not known.
+    """
+
+    edges = np.asarray(bins, dtype=float)
+    counts = np.zeros(len(edges) - 1, dtype=np.int64)
+    for f, v in stream:
+        counts += np.histogram(v, edges)[0]
+
+    return (counts, edges)
+
+class MonteCarloResult:
+    """ Summary statistics from monte_carlo(). Each statistic is an array with
+    one entry per frequency.
+
+    freqs                           - frequencies evaluated
+    n_samples                       - number of draws
+    tau_mean, tau_std, tau_min, tau_max - statistics of |tau|
+    P_mean, P_std, P_min, P_max     - statistics of |P_load|
+    threshold                       - minimum acceptable |tau| (or None)
+    yield_freq                      - fraction of draws with |tau| >= threshold
+                                      at each frequency
+    yield_all                       - fraction of draws with |tau| >= threshold
+                                      at every frequency
+    """
+
+    def __init__(self, freqs, threshold):
+
+        self.freqs = freqs
+        self.threshold = threshold
+        self.n_samples = 0
+
+        shape = np.shape(freqs)
+        self.tau_mean = np.zeros(shape)
+        self.tau_std = np.zeros(shape)
+        self.tau_min = np.full(shape, np.inf)
+        self.tau_max = np.full(shape, -np.inf)
+        self.P_mean = np.zeros(shape)
+        self.P_std = np.zeros(shape)
+        self.P_min = np.full(shape, np.inf)
+        self.P_max = np.full(shape, -np.inf)
+
+        self.yield_freq = None
+        self.yield_all = None
+
+        self._tau_M2 = np.zeros(shape)
+        self._P_M2 = np.zeros(shape)
+        self._pass_freq = np.zeros(shape)
+        self._pass_all = 0
+
+    def __str__(self):
+        out = f"Monte Carlo: {self.n_samples} draws, {np.size(self.freqs)} frequencies\n"
+        out = out + f"\t|tau|: mean {np.mean(self.tau_mean)}, min {np.min(self.tau_min)}, max {np.max(self.tau_max)}\n"
+        if self.yield_all is not None:
+            out = out + f"\tYield (|tau| >= {self.threshold}): {self.yield_all}\n"
+        return out
+
+    def __repr__(self):
+        return self.__str__()
+
+    def add(self, tau, P):
+        """ Adds a chunk of draws (arrays of shape (draws, freqs)) to the
+        statistics.
+        """
+
+        tau = _cabs(tau)
+        P = _cabs(P)
+        n = tau.shape[0]
+        n_tot = self.n_samples + n
+
+        #Combine means and sums of squared deviations chunk by chunk (Chan et al.)
+        for x, mean, M2 in ((tau, self.tau_mean, self._tau_M2), (P, self.P_mean, self._P_M2)):
+            x_mean = np.mean(x, axis=0)
+            delta = x_mean - mean
+            M2 += np.sum((x - x_mean)**2, axis=0) + delta**2*self.n_samples*n/n_tot
+            mean += delta*n/n_tot
+
+        self.tau_min = np.minimum(self.tau_min, np.min(tau, axis=0))
+        self.tau_max = np.maximum(self.tau_max, np.max(tau, axis=0))
+        self.P_min = np.minimum(self.P_min, np.min(P, axis=0))
+        self.P_max = np.maximum(self.P_max, np.max(P, axis=0))
+
+        if self.threshold is not None:
+            passed = (tau >= self.threshold)
+            self._pass_freq += np.sum(passed, axis=0)
+            self._pass_all += int(np.sum(np.all(passed, axis=1)))
+
+        self.n_samples = n_tot
+        self.tau_std = np.sqrt(self._tau_M2/n_tot)
+        self.P_std = np.sqrt(self._P_M2/n_tot)
+
+        if self.threshold is not None:
+            self.yield_freq = self._pass_freq/n_tot
+            self.yield_all = self._pass_all/n_tot
+
+def _tolerance_targets(cc, tolerances:dict):
+    """ Resolves the parameter names of a tolerance dict (see monte_carlo())
+    to a list of (kind, element index, tolerance), where kind is 'R', 'L',
+    'C', 'Z_S', 'Z_L' or 'VIN'. Returns None if a name is invalid.
+    """
+
+    targets = []
+    for param, tol in tolerances.items():
+
+        if param.upper() in ("Z_S", "Z_L", "VIN"):
+            targets.append((param.upper(), None, tol))
+            continue
+
+        words = param.split()
+        if len(words) < 2 or words[1].upper() not in ("R", "L", "C"):
+            print(f"ERROR: Invalid tolerance parameter '{param}'.")
+            return None
+
+        idx = _find_element(cc, words[0])
+        if idx is None:
+            print(f"ERROR: Element '{words[0]}' not found.")
+            return None
+
+        targets.append((words[1].upper(), idx, tol))
+
+    return targets
+
+def _draw_networks(network, cc, targets:list, u, freqs=None):
+    """ Builds the values of a batch of networks from a (draws x targets)
+    array u of relative deviations (value = nominal*(1 + u)).
+
+    Returns (R, L, C, Z_s, Z_l, V_in), where R, L and C have shape
+    (elements, draws) and Z_s, Z_l and V_in have shape (draws, 1) so they
+    broadcast against the frequency dimension. A TabulatedImpedance Z_s or
+    Z_l is evaluated at freqs, giving shape (draws, freqs).
+    """
+
+    n = u.shape[0]
+    R = np.repeat(cc.R[:, None], n, axis=1)
+    L = np.repeat(cc.L[:, None], n, axis=1)
+    C = np.repeat(cc.C[:, None], n, axis=1)
+    Z_s = np.repeat(np.atleast_1d(np.asarray(_impedance(network.Z_s, freqs), dtype=complex))[np.newaxis], n, axis=0)
+    Z_l = np.repeat(np.atleast_1d(np.asarray(_impedance(network.Z_l, freqs), dtype=complex))[np.newaxis], n, axis=0)
+    V_in = np.full((n, 1), network.V_in, dtype=float)
+
+    for k, (kind, idx, tol) in enumerate(targets):
+        scale = 1 + u[:, k]
+        if kind == "R":
+            R[idx] *= scale
+        elif kind == "L":
+            L[idx] *= scale
+        elif kind == "C":
+            C[idx] *= scale
+        elif kind == "Z_S":
+            Z_s *= scale[:, np.newaxis]
+        elif kind == "Z_L":
+            Z_l *= scale[:, np.newaxis]
+        elif kind == "VIN":
+            V_in[:, 0] *= scale
+
+    return (R, L, C, Z_s, Z_l, V_in)
+
+def _eval_draws(network, cc, targets:list, u, freqs):
+    """ Evaluates tau and P_load for a batch of relative deviations u (see
+    _draw_networks()) at every frequency in the 1D array freqs. Returns two
+    (draws x freqs) arrays.
+    """
+
+    R, L, C, Z_s, Z_l, V_in = _draw_networks(network, cc, targets, u, freqs)
+    Z_net = cc.Z_out(freqs, Z_s, R, L, C)
+
+    return (tau_load(Z_l, Z_net), P_load(Z_l, Z_net, V_in))
+
+def monte_carlo(network, tolerances:dict, n_samples:int, freqs=None, threshold:float=None, distribution:str="uniform", chunk_size:int=1000, seed=None, sink=None):
+    """ Estimates the spread of tau and P_load caused by component tolerances.
+
+    tolerances maps parameter names (as in sensitivity(), eg. "L1 L" or
+    "Z_s") to a relative tolerance (0.01 -> +/-1%). With the "uniform"
+    distribution each value is drawn uniformly within its tolerance. With
+    "normal" the tolerance is taken as three standard deviations.
+
+    Draws are evaluated chunk_size at a time, with all draws and frequencies
+    of a chunk handled in single array operations. Peak memory is set by
+    chunk_size x len(freqs) x (number of elements), not by n_samples.
+
+    freqs (a float or 1D array) defaults to network.freq. If threshold is
+    given, the yield (the fraction of draws with |tau| >= threshold) is
+    reported.
+
+    sink, if given, is called with the (tau, P) arrays of every chunk, each
+    shaped (draws, freqs), so every draw can be kept on disk (eg. the
+    append() method of a ResultWriter of shape (n_samples, len(freqs), 2)).
+
+    Returns a MonteCarloResult, or None if a parameter is invalid.
+    """
+
+    cc = compile_circuit(network.circ)
+    if cc is None:
+        return None
+
+    targets = _tolerance_targets(cc, tolerances)
+    if targets is None:
+        return None
+
+    if distribution.upper() not in ("UNIFORM", "NORMAL"):
+        print(f"ERROR: Unrecognized distribution '{distribution}'. Options are 'uniform' and 'normal'.")
+        return None
+
+    if freqs is None:
+        freqs = network.freq
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+
+    rng = np.random.default_rng(seed)
+    tol = np.array([t[2] for t in targets], dtype=float)
+    result = MonteCarloResult(freqs, threshold)
+
+    done = 0
+    while done < n_samples:
+        n = min(chunk_size, n_samples - done)
+
+        if distribution.upper() == "UNIFORM":
+            u = rng.uniform(-1, 1, (n, len(targets)))*tol
+        else:
+            u = rng.standard_normal((n, len(targets)))*tol/3
+
+        tau, P = _eval_draws(network, cc, targets, u, freqs)
+        result.add(tau, P)
+        if sink is not None:
+            sink(tau, P)
+        done += n
+
+    return result
+
+def _norm_cdf(z):
+    """ Standard normal CDF of an array. Uses scipy if it is installed,
+    otherwise a Chebyshev fit of erfc (fractional error below 1.2e-7, also
+    in the tails).
+    """
+
+    z = np.asarray(z, dtype=float)
+    if _ndtr is not None:
+        return _ndtr(z)
+
+    x = np.abs(z)/np.sqrt(2)
+    t = 1/(1 + 0.5*x)
+    poly = -1.26551223 + t*(1.00002368 + t*(0.37409196 + t*(0.09678418 + t*(-0.18628806 + t*(0.27886807 + t*(-1.13520398 + t*(1.48851587 + t*(-0.82215223 + t*0.17087277))))))))
+    half_erfc = 0.5*t*np.exp(-x*x + poly)
+
+    return np.where(z < 0, half_erfc, 1 - half_erfc)
+
+def _norm_ppf(p):
+    """ Inverse of the standard normal CDF of an array of probabilities in
+    (0, 1). Uses scipy if it is installed, otherwise Acklam's rational
+    approximation (relative error below 1.2e-9).
+    """
+
+    p = np.asarray(p, dtype=float)
+    if _ndtri is not None:
+        return _ndtri(p)
+
+    a = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02, 1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00)
+    b = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02, 6.680131188771972e+01, -1.328068155288572e+01)
+    c = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00, -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00)
+    d = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00, 3.754408661907416e+00)
+
+    #Central region
+    q = p - 0.5
+    r = q*q
+    x = (((((a[0]*r + a[1])*r + a[2])*r + a[3])*r + a[4])*r + a[5])*q/(((((b[0]*r + b[1])*r + b[2])*r + b[3])*r + b[4])*r + 1)
+
+    #Tails, using the smaller of p and 1 - p
+    pt = np.minimum(p, 1 - p)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = np.sqrt(-2*np.log(pt))
+    xt = (((((c[0]*q + c[1])*q + c[2])*q + c[3])*q + c[4])*q + c[5])/((((d[0]*q + d[1])*q + d[2])*q + d[3])*q + 1)
+
+    return np.where(pt < 0.02425, np.where(p < 0.5, xt, -xt), x)
+
+class HaltonSequence:
+    """ Scrambled Halton low discrepancy sequence in d dimensions. Dimension
+    j uses the j-th prime as its base, and each digit position of each
+    dimension gets its own random permutation of the digits (fixed by seed),
+    which breaks up the correlation between high dimensions of the plain
+    sequence. random(n) returns the next n points in [0, 1)^d, as an (n, d)
+    array, like scipy.stats.qmc engines.
+    """
+
+    def __init__(self, d:int, seed=None):
+
+        rng = np.random.default_rng(seed)
+        self.d = d
+        self.index = 0
+
+        #First d primes
+        self.bases = []
+        p = 2
+        while len(self.bases) < d:
+            if all(p % b for b in self.bases):
+                self.bases.append(p)
+            p += 1
+
+        #Enough digits for double precision in every base
+        self.perms = []
+        for b in self.bases:
+            levels = int(53*np.log(2)/np.log(b)) + 1
+            self.perms.append(np.array([rng.permutation(b) for k in range(levels)]))
+        self.jitter = rng.random(d)
+
+    def random(self, n:int):
+        """ Returns the next n points of the sequence """
+
+        i = np.arange(self.index, self.index + n, dtype=np.int64)
+        self.index += n
+
+        out = np.empty((n, self.d))
+        for j, b in enumerate(self.bases):
+            x = np.zeros(n)
+            k = i.copy()
+            scale = 1.0/b
+            for perm in self.perms[j]:
+                x += perm[k % b]*scale
+                k //= b
+                scale /= b
+            #Randomize below the last digit
+            out[:, j] = x + self.jitter[j]*scale*b
+
+        return out
+
+def _qmc_engine(method:str, d:int, seed):
+    """ Returns a low discrepancy sequence with a random(n) method, or None
+    if the method is unavailable.
+    """
+
+    if method == "HALTON":
+        return HaltonSequence(d, seed)
+
+    try:
+        from scipy.stats import qmc
+    except ImportError:
+        print("ERROR: Sobol sampling requires scipy. Use method='halton' instead.")
+        return None
+
+    return qmc.Sobol(d, scramble=True, seed=seed)
+
+def _limit_metric(network, cc, targets:list, z, freqs, distribution:str):
+    """ Maps standard normal points z (draws x targets) to relative
+    deviations (see _draw_networks()) and returns the smallest |tau| over
+    freqs for each draw. Uniform tolerances are mapped through the normal
+    CDF, so both distributions are sampled in the same space.
+    """
+
+    tol = np.array([t[2] for t in targets], dtype=float)
+    if distribution == "UNIFORM":
+        u = (2*_norm_cdf(z) - 1)*tol
+    else:
+        u = z*tol/3
+
+    tau = _eval_draws(network, cc, targets, u, freqs)[0]
+
+    return np.min(_cabs(tau), axis=1)
+
+class YieldResult:
+    """ Result of estimate_yield().
+
+    yield_est     - estimated fraction of networks with |tau| >= spec at every
+                    frequency
+    p_fail        - estimated failure probability (1 - yield_est)
+    ci            - (low, high) confidence interval of the yield
+    half_width    - half width of the confidence interval
+    confidence    - confidence level of ci
+    n_samples     - networks evaluated, including any used to set up the
+                    importance sampling
+    method        - sampling method used
+    converged     - True if the target precision was reached
+    """
+
+    def __init__(self, p_fail:float, half_width:float, confidence:float, n_samples:int, method:str, converged:bool):
+
+        self.p_fail = p_fail
+        self.yield_est = 1 - p_fail
+        self.half_width = half_width
+        self.ci = (max(0, self.yield_est - half_width), min(1, self.yield_est + half_width))
+        self.confidence = confidence
+        self.n_samples = n_samples
+        self.method = method
+        self.converged = converged
+
+    def __str__(self):
+        out = f"Yield ({self.method}, {self.n_samples} evaluations): {self.yield_est}\n"
+        out = out + f"\t{self.confidence*100}% interval: {self.ci}{'' if self.converged else ' (target precision not reached)'}\n"
+        return out
+
+    def __repr__(self):
+        return self.__str__()
+
+def estimate_yield(network, tolerances:dict, spec:float, freqs=None, method:str="halton", distribution:str="uniform", rel_precision:float=0.1, abs_precision:float=0, confidence:float=0.95, batch_size:int=4096, max_samples:int=10**6, replicates:int=16, min_failures:int=10, seed=None):
+    """ Estimates the yield, the fraction of networks with |tau| >= spec at
+    every frequency in freqs, for the component tolerances given as in
+    monte_carlo(). Sampling continues in batches until the confidence
+    interval half width is at most the larger of abs_precision and
+    rel_precision times the failure probability (after at least min_failures
+    failures are seen), or max_samples is reached.
+
+    method:
+        "random"     - plain Monte Carlo
+        "halton"     - randomized quasi-Monte Carlo with scrambled Halton
+                       sequences (see HaltonSequence)
+        "sobol"      - as halton, with scrambled Sobol sequences (requires
+                       scipy)
+        "importance" - importance sampling. The sampling distribution is
+                       moved towards the failure region by cross-entropy
+                       iterations, each one batch of draws. Draws come from
+                       it (mixed with the nominal distribution, so weights
+                       stay bounded) and are weighted by their likelihood
+                       ratio.
+    For the quasi-Monte Carlo methods, the interval comes from the spread of
+    independently scrambled replicates.
+
+    Returns a YieldResult, or None if an argument is invalid.
+    """
+
+    cc = compile_circuit(network.circ)
+    if cc is None:
+        return None
+
+    targets = _tolerance_targets(cc, tolerances)
+    if targets is None:
+        return None
+
+    method = method.upper()
+    distribution = distribution.upper()
+    if method not in ("RANDOM", "HALTON", "SOBOL", "IMPORTANCE"):
+        print(f"ERROR: Unrecognized method '{method}'. Options are 'random', 'halton', 'sobol' and 'importance'.")
+        return None
+    if distribution not in ("UNIFORM", "NORMAL"):
+        print(f"ERROR: Unrecognized distribution '{distribution}'. Options are 'uniform' and 'normal'.")
+        return None
+
+    if freqs is None:
+        freqs = network.freq
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+
+    d = len(targets)
+    rng = np.random.default_rng(seed)
+    z_conf = NormalDist().inv_cdf((1 + confidence)/2)
+    n = 0
+
+    def metric(z):
+        nonlocal n
+        n += len(z)
+        return _limit_metric(network, cc, targets, z, freqs, distribution)
+
+    def done(p, hw, fails):
+        return fails >= min_failures and hw <= max(abs_precision, rel_precision*p)
+
+    if method in ("HALTON", "SOBOL"):
+        engines = []
+        for r in range(replicates):
+            engine = _qmc_engine(method, d, rng.integers(2**32))
+            if engine is None:
+                return None
+            engines.append(engine)
+
+        #Sobol points are balanced in powers of two
+        per = max(1, batch_size//replicates)
+        per = 2**int(np.round(np.log2(per)))
+        fails = np.zeros(replicates)
+        count = 0
+
+        while True:
+            for r, engine in enumerate(engines):
+                x = np.clip(engine.random(per), 1e-16, 1 - 1e-16)
+                fails[r] += np.sum(metric(_norm_ppf(x)) < spec)
+            count += per
+
+            p_r = fails/count
+            p = np.mean(p_r)
+            hw = z_conf*np.std(p_r, ddof=1)/np.sqrt(replicates)
+            if done(p, hw, np.sum(fails)) or n >= max_samples:
+                break
+
+        return YieldResult(p, hw, confidence, n, method.lower(), bool(done(p, hw, np.sum(fails))))
+
+    #Proposal: a mixture of N(0, I) (defensive, weight 0.1) and N(mu, I),
+    #with mu moved into the failure region by cross-entropy iterations. Each
+    #draws a batch from N(mu, I), lowers the level to the 10% quantile of
+    #the worst |tau| (or spec), and moves mu to the likelihood weighted mean
+    #of the draws below that level.
+    mus = np.zeros((1, d))
+    weights = np.ones(1)
+    if method == "IMPORTANCE":
+        mu = np.zeros(d)
+        for it in range(20):
+            z = rng.standard_normal((batch_size, d)) + mu
+            m = metric(z)
+            level = max(spec, np.quantile(m, 0.1))
+            elite = m <= level
+            w = np.exp(-(z[elite] @ mu) + (mu @ mu)/2)
+            mu = (w @ z[elite])/np.sum(w)
+            if level == spec:
+                break
+
+        mus = np.vstack((mus, mu))
+        weights = np.array([0.1, 0.9])
+
+    total = 0
+    total_sq = 0
+    fails = 0
+    count = 0
+    while True:
+        comp = rng.choice(len(mus), batch_size, p=weights)
+        z = rng.standard_normal((batch_size, d)) + mus[comp]
+        f = (metric(z) < spec).astype(float)
+
+        #Likelihood ratio of N(0, I) to the mixture
+        q = np.exp(z @ mus.T - np.sum(mus*mus, axis=1)/2) @ weights
+        w = f/q
+        total += np.sum(w)
+        total_sq += np.sum(w*w)
+        fails += np.sum(f)
+        count += batch_size
+
+        p = total/count
+        var = max(total_sq/count - p*p, 0)
+        hw = z_conf*np.sqrt(var/count)
+        if done(p, hw, fails) or n >= max_samples:
+            break
+
+    return YieldResult(p, hw, confidence, n, method.lower(), bool(done(p, hw, fails)))
+
+def _aa_rad(a):
+    """ Radius of a complex affine form: the largest |z - centre| """
+
+    return np.sum(np.abs(a[1]), axis=-1) + a[2]
+
+def _aa_add(a, b):
+    """ Sum of two complex affine forms (centre, coefficients, radius) """
+
+    return (a[0] + b[0], a[1] + b[1], a[2] + b[2])
+
+def _aa_mul(a, b):
+    """ Product of two complex affine forms. The second order terms are
+    bounded into the radius.
+    """
+
+    with np.errstate(invalid='ignore'):
+        r = np.abs(a[0])*b[2] + np.abs(b[0])*a[2] + _aa_rad(a)*_aa_rad(b)
+    r = np.where(np.isnan(r), np.inf, r)
+
+    return (a[0]*b[0], a[0][..., np.newaxis]*b[1] + b[0][..., np.newaxis]*a[1], r)
+
+def _aa_rec(a):
+    """ Reciprocal of a complex affine form, linearized at the centre c.
+    For |z - c| <= rho < |c|, |1/z - 1/c + (z - c)/c^2| <= rho^2/(|c|^2 (|c| - rho)),
+    which goes into the radius. The result is unbounded if rho >= |c|.
+    """
+
+    c = a[0]
+    m = np.abs(c)
+    rho = _aa_rad(a)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        inv = np.where(m > 0, 1/c, 0)
+        r = a[2]/(m*m) + rho*rho/(m*m*(m - rho))
+        r = np.where((rho < m) & ~np.isnan(r), r, np.inf)
+
+    return (inv, -a[1]*(inv*inv)[..., np.newaxis], r)
+
+def _aa_pall(a, b):
+    """ Parallel combination of two complex affine forms """
+
+    return _aa_rec(_aa_add(_aa_rec(a), _aa_rec(b)))
+
+def _tau_lower_bound(network, cc, targets:list, lo, hi, freqs):
+    """ Lower bound on the smallest |tau| over freqs for every network with
+    relative deviations between lo and hi, two (boxes x targets) arrays.
+
+    Each stage of the Z_out() recursion is carried as a complex affine form:
+    a centre, one coefficient per toleranced parameter (each ranging over
+    [-1, 1]) and a radius bounding all higher order terms. Unlike plain
+    intervals, this keeps track of the correlation between stages, so the
+    bound stays tight through deep ladders.
+    """
+
+    B, n = lo.shape
+    nf = len(freqs)
+    mid = (lo + hi)/2
+    half = (hi - lo)/2
+    w = 2*3.14159*np.asarray(freqs, dtype=float)
+
+    zeros = np.zeros((B, nf))
+    no_terms = np.zeros((B, nf, n), dtype=complex)
+
+    def const(z):
+        return (z + zeros.astype(complex), no_terms, zeros)
+
+    #Affine form of value*(1 + u) for each (kind, index) that is toleranced
+    forms = {}
+    for k, (kind, idx, tol) in enumerate(targets):
+        A = np.zeros((B, n))
+        A[:, k] = half[:, k]
+        forms[(kind, idx)] = (1 + mid[:, k], A)
+
+    def scaled(kind, idx, v, factor):
+        """ Affine form of factor*value, with factor complex, broadcast over freq """
+        fv = np.broadcast_to(np.asarray(factor*v, dtype=complex), (nf,))
+        if (kind, idx) not in forms:
+            return const(fv)
+        m, A = forms[(kind, idx)]
+        return (fv*m[:, np.newaxis], fv[:, np.newaxis]*A[:, np.newaxis, :], zeros)
+
+    j = complex(0, 1)
+    Z = scaled("Z_S", None, _impedance(network.Z_s, freqs), 1)
+    for i in range(len(cc)):
+        R = scaled("R", i, cc.R[i], 1)
+        Z_L = scaled("L", i, cc.L[i], j*w)
+
+        #Elements without capacitance reduce to R + Z_L, as in Component.Z()
+        if cc.C[i] == 0:
+            Ze = _aa_add(R, Z_L)
+        else:
+            Y_C = scaled("C", i, cc.C[i], j*w)
+            t = cc.types[i]
+            if t == Passive.C.value:
+                Ze = _aa_add(_aa_add(R, Z_L), _aa_rec(Y_C))
+            elif t == Passive.L.value:
+                Ze = _aa_rec(_aa_add(_aa_rec(_aa_add(Z_L, R)), Y_C))
+            elif cc.R[i] == 0:
+                Ze = Z_L
+            else:
+                Ze = _aa_add(Z_L, _aa_rec(_aa_add(_aa_rec(R), Y_C)))
+
+        if cc.series[i]:
+            Z = _aa_add(Z, Ze)
+        else:
+            Z = _aa_pall(Z, Ze)
+
+    #tau = 4*Z_l*Z/(Z_l + Z)^2
+    Z_l = scaled("Z_L", None, _impedance(network.Z_l, freqs), 1)
+    S = _aa_add(Z_l, Z)
+    tau = _aa_mul(_aa_mul(Z_l, Z), _aa_rec(_aa_mul(S, S)))
+
+    #|tau| >= Re(tau*conj(c)/|c|), so linear terms changing only the phase of
+    #tau drop out of the bound
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = np.abs(tau[0])
+        u = np.conj(tau[0])/m
+        lb = 4*(m - np.sum(np.abs((tau[1]*u[..., np.newaxis]).real), axis=-1) - tau[2])
+    lb = np.where(np.isnan(lb), 0, np.maximum(lb, 0))
+
+    return np.min(lb, axis=1)
+
+class WorstCaseResult:
+    """ Result of worst_case().
+
+    tau_min     - smallest |tau| over every tolerance corner and frequency
+    tau         - complex tau at that corner and frequency
+    freq        - frequency of the worst case
+    corner      - maps each toleranced parameter to its deviation at the
+                  worst corner (+tol or -tol)
+    evaluations - corners evaluated exactly
+    boxes       - sub-boxes bounded by interval evaluation
+    pruned      - sub-boxes pruned
+    """
+
+    def __init__(self, tau_min:float, tau:complex, freq:float, corner:dict, evaluations:int, boxes:int, pruned:int):
+
+        self.tau_min = tau_min
+        self.tau = tau
+        self.freq = freq
+        self.corner = corner
+        self.evaluations = evaluations
+        self.boxes = boxes
+        self.pruned = pruned
+
+    def __str__(self):
+        out = f"Worst case |tau| = {self.tau_min} at {self.freq} Hz ({self.evaluations} corners evaluated, {self.pruned}/{self.boxes} boxes pruned)\n"
+        for p, u in self.corner.items():
+            out = out + f"\t{p}: {u:+}\n"
+        return out
+
+    def __repr__(self):
+        return self.__str__()
+
+def worst_case(network, tolerances:dict, freqs=None, leaf_size:int=6, batch_size:int=256):
+    """ Finds the tolerance corner (every parameter at +tol or -tol, see
+    monte_carlo() for the tolerances format) giving the smallest |tau| at
+    any frequency in freqs (default network.freq).
+
+    Corners are searched by branch and bound. Parameters are fixed one at a
+    time, most sensitive first. For each sub-box of corners, a lower bound
+    on |tau| is carried through every stage of the ladder (see
+    _tau_lower_bound()). Sub-boxes that cannot beat the worst corner found
+    so far are pruned, and those with at most leaf_size free parameters
+    have all their corners evaluated directly. Up to batch_size boxes are processed per
+    step, each as one vectorized evaluation.
+
+    Returns a WorstCaseResult, or None if a parameter is invalid.
+    """
+
+    cc = compile_circuit(network.circ)
+    if cc is None:
+        return None
+
+    targets = _tolerance_targets(cc, tolerances)
+    if targets is None:
+        return None
+
+    #Vin does not affect tau
+    params = [p for p, t in zip(tolerances, targets) if t[0] != "VIN"]
+    targets = [t for t in targets if t[0] != "VIN"]
+
+    if freqs is None:
+        freqs = network.freq
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+
+    n = len(targets)
+    tol = np.array([t[2] for t in targets], dtype=float)
+    evaluations = 0
+
+    def corners(S):
+        nonlocal evaluations
+        evaluations += len(S)
+        tau = _eval_draws(network, cc, targets, S*tol, freqs)[0]
+        return tau, np.min(_cabs(tau), axis=1)
+
+    #Order parameters by their effect on |tau| at the nominal design
+    h = 1e-3
+    E = np.vstack((np.eye(n), -np.eye(n)))
+    g = corners(E*h)[1]
+    g = g[:n] - g[n:]
+    order = np.argsort(-np.abs(g), kind='stable')
+    greedy = -np.sign(g)
+    greedy[greedy == 0] = 1
+
+    best_S = greedy.copy()
+    best = corners(greedy[np.newaxis])[1][0]
+
+    def update(S, tau_min):
+        nonlocal best, best_S
+        k = np.argmin(tau_min)
+        if tau_min[k] < best:
+            best = tau_min[k]
+            best_S = S[k].copy()
+
+    #Frontier of boxes: S holds +1/-1 for fixed parameters and 0 for free
+    #ones, with parameters fixed in 'order'. lb is each box's lower bound.
+    S_front = np.zeros((1, n))
+    lb_front = np.zeros(1)
+    boxes = 0
+    pruned = 0
+
+    while len(S_front) > 0:
+
+        #Take the most promising boxes first
+        keep = lb_front < best
+        pruned += np.sum(~keep)
+        S_front = S_front[keep]
+        lb_front = lb_front[keep]
+        if len(S_front) == 0:
+            break
+        first = np.argsort(lb_front, kind='stable')[:batch_size]
+        S = S_front[first]
+        rest = np.ones(len(S_front), dtype=bool)
+        rest[first] = False
+        S_front = S_front[rest]
+        lb_front = lb_front[rest]
+
+        free = np.sum(S == 0, axis=1)
+
+        #Small boxes: evaluate every corner
+        leaves = S[free <= leaf_size]
+        for node in leaves:
+            f = np.flatnonzero(node == 0)
+            bits = (np.arange(2**len(f))[:, np.newaxis] >> np.arange(len(f))) & 1
+            C = np.repeat(node[np.newaxis], len(bits), axis=0)
+            C[:, f] = 2*bits - 1
+            update(C, corners(C)[1])
+
+        #Larger boxes: split on the next parameter and bound both halves
+        S = S[free > leaf_size]
+        if len(S) == 0:
+            continue
+        k = order[n - np.sum(S == 0, axis=1)]
+        children = np.repeat(S, 2, axis=0)
+        children[np.arange(len(children)), np.repeat(k, 2)] = np.tile([1, -1], len(S))
+
+        lo = np.where(children == 0, -1, children)*tol
+        hi = np.where(children == 0, 1, children)*tol
+        lb = _tau_lower_bound(network, cc, targets, lo, hi, freqs)
+        boxes += len(children)
+
+        #Complete each child greedily, to tighten the bound early
+        greedy_C = np.where(children == 0, greedy, children)
+        update(greedy_C, corners(greedy_C)[1])
+
+        S_front = np.vstack((S_front, children))
+        lb_front = np.concatenate((lb_front, lb))
+
+    tau = corners(best_S[np.newaxis])[0][0]
+    i = np.argmin(_cabs(tau))
+    corner = {p: float(s*t) for p, s, t in zip(params, best_S, tol)}
+
+    return WorstCaseResult(float(best), complex(tau[i]), float(freqs[i]), corner, evaluations, boxes, int(pruned))
+
+class OptimizeResult:
+    """ Result of optimize_network().
+
+    network      - copy of the network with the optimized values (its circ is
+                   a CompiledCircuit)
+    values       - maps each tuned parameter to its optimized value
+    transmission - transmission_net() at the center frequency
+    peak_sens    - largest |dtau/tau| for a pcnt percent change of any tuned
+                   parameter, over the band
+    objective    - weight times the smooth aggregate of |dtau/tau| (see
+                   _design_objective()) minus transmission, plus any penalty
+    iterations   - quasi-Newton iterations taken
+    evaluations  - candidate designs evaluated
+    """
+
+    def __init__(self, network, values:dict, transmission:float, peak_sens:float, objective:float, iterations:int, evaluations:int):
+
+        self.network = network
+        self.values = values
+        self.transmission = transmission
+        self.peak_sens = peak_sens
+        self.objective = objective
+        self.iterations = iterations
+        self.evaluations = evaluations
+
+    def __str__(self):
+        out = f"Optimized in {self.iterations} iterations ({self.evaluations} designs evaluated)\n"
+        out = out + f"\ttransmission: {self.transmission}, peak |dtau/tau|: {self.peak_sens}\n"
+        for p, v in self.values.items():
+            out = out + f"\t{p} = {v}\n"
+        return out
+
+    def __repr__(self):
+        return self.__str__()
+
+def _tunable_targets(cc, params:list):
+    """ Returns a list of (value array name, element index, nominal value)
+    for each element parameter in params ("<element> R/L/C"), or None if one
+    is invalid.
+    """
+
+    targets = []
+    for p in params:
+        words = p.split()
+        idx = None if len(words) < 2 else cc.index.get(words[0].upper())
+        if idx is None or words[1].upper() not in ("R", "L", "C"):
+            print(f"ERROR: Invalid element parameter '{p}'.")
+            return None
+
+        kind = words[1].upper()
+        p0 = float(getattr(cc, kind)[idx])
+        if p0 <= 0:
+            print(f"ERROR: Parameter '{p}' must start from a positive value.")
+            return None
+        targets.append((kind, idx, p0))
+
+    return targets
+
+def _design_values(cc, targets:list, X):
+    """ Returns (R, L, C) arrays of shape (elements, designs) with each tuned
+    parameter scaled by exp(X[:, j]).
+    """
+
+    vals = {"R": cc.R, "L": cc.L, "C": cc.C}
+    vals = {k: np.repeat(v[:, np.newaxis], len(X), axis=1) for k, v in vals.items()}
+    for j, (kind, idx, p0) in enumerate(targets):
+        vals[kind][idx] = p0*np.exp(X[:, j])
+
+    return (vals["R"], vals["L"], vals["C"])
+
+def _smooth_max(s, q:float):
+    """ Returns the q-norm mean (mean(s^q))^(1/q) over the last axis of the
+    non-negative array s, a smooth stand-in for its maximum, and its
+    derivative with respect to each entry of s.
+    """
+
+    m = np.max(s, axis=-1, keepdims=True)
+    r = np.divide(s, m, out=np.zeros_like(s), where=m > 0)
+    mean = np.mean(r**q, axis=-1, keepdims=True)
+    norm = np.where(m > 0, mean, 1)**(1/q)
+    w = r**(q - 1)/(s.shape[-1]*np.where(m > 0, mean, 1)**((q - 1)/q))
+
+    return ((m*norm)[..., 0], w)
+
+def _design_objective(network, cc, targets:list, X, f0:float, band, weight:float, pcnt:float, T_min:float, q:float, mu:float):
+    """ Evaluates a batch of designs (rows of X, see _design_values()).
+    Returns arrays (objective, transmission, smooth_sens, peak_sens), one
+    entry per design.
+
+    The sensitivity of each tuned parameter is |dtau/tau| for a pcnt
+    percent change, ie. |dln(tau)/dln(p)|*pcnt/100, at every frequency in
+    band. smooth_sens is its q-norm mean over parameters and frequencies
+    (see _smooth_max()) and peak_sens its maximum. The objective is
+    weight*smooth_sens - transmission + mu*max(0, T_min - transmission)^2.
+    """
+
+    R, L, C = _design_values(cc, targets, X)
+
+    T = transmission_load(_impedance(network.Z_l, f0), cc.Z_out(f0, _impedance(network.Z_s, f0), R, L, C))
+
+    #dln(tau)/dZ = 1/Z - 2/(Zl + Z), from one forward/backward ladder pass
+    #for every design
+    Z_l = _impedance(network.Z_l, band)
+    Zout, dR, dL, dC, dZs, df = cc.grad_Z_out(band, _impedance(network.Z_s, band), R, L, C)
+    g = 1/Zout - 2/(Z_l + Zout)
+
+    dZ = {"R": dR, "L": dL, "C": dC}
+    vals = {"R": R, "L": L, "C": C}
+    s = np.stack([np.abs(g*dZ[kind][idx])*vals[kind][idx][:, np.newaxis] for kind, idx, p0 in targets], axis=1)
+    s = s.reshape((len(X), -1))*pcnt/100.0
+
+    smooth = _smooth_max(s, q)[0]
+    obj = weight*smooth - T + mu*np.maximum(0, T_min - T)**2
+
+    return (obj, T, smooth, np.max(s, axis=-1))
+
+def _design_gradient(network, cc, targets:list, x, f0:float, band, weight:float, pcnt:float, T_min:float, q:float, mu:float):
+    """ Returns the exact gradient of _design_objective() with respect to x
+    for one design, from the derivatives of Zout at f0 (see
+    CompiledCircuit.grad_Z_out()) and of tau across band (see
+    hessian_net()).
+    """
+
+    R, L, C = _design_values(cc, targets, x[np.newaxis])
+    design = CompiledCircuit(R[:, 0], L[:, 0], C[:, 0], cc.types, cc.series, cc.names)
+    rows = [3*idx + "RLC".index(kind) for kind, idx, p0 in targets]
+    p = np.array([{"R": R, "L": L, "C": C}[kind][idx, 0] for kind, idx, p0 in targets])
+
+    #Transmission 4*Re(Zl)*Re(Z)/|Zl + Z|^2 at f0
+    Z_l = _impedance(network.Z_l, f0)
+    out = design.grad_Z_out(f0, _impedance(network.Z_s, f0))
+    Z = out[0]
+    dZ = np.stack(out[1:4], axis=1).reshape(-1)[rows]*p
+    S = Z_l + Z
+    S2 = S.real*S.real + S.imag*S.imag
+    T = 4*Z_l.real*Z.real/S2
+    dT = 4*Z_l.real*(dZ.real*S2 - 2*Z.real*np.real(np.conj(S)*dZ))/(S2*S2)
+
+    #u[j] = dln(tau)/dln(p_j) and du[j]/dln(p_i) across the band
+    net = Network(design, network.Z_s, network.Z_l, f0)
+    params, dtau, d2tau = hessian_net(net, band)
+    tau = tau_net(net, band)
+    u = dtau[rows]*p[:, np.newaxis]/tau
+    du = d2tau[np.ix_(rows, rows)]*np.outer(p, p)[..., np.newaxis]/tau - u[:, np.newaxis]*u[np.newaxis, :]
+    du[np.arange(len(p)), np.arange(len(p))] += u
+
+    s = np.abs(u)*pcnt/100.0
+    ds = np.real(np.conj(u)[np.newaxis]*du)/np.abs(u)[np.newaxis]*pcnt/100.0
+    w = _smooth_max(s.reshape(-1), q)[1].reshape(s.shape)
+    dsmooth = np.sum(ds*w[np.newaxis], axis=(1, 2))
+
+    return weight*dsmooth - dT - 2*mu*max(0, T_min - T)*dT
+
+def optimize_network(network, params:list, band:tuple, weight:float=1, n_band:int=21, pcnt:float=1, max_ratio:float=10, max_iter:int=100, tol:float=1e-10, min_transmission:float=None):
+    """ Tunes the element parameters in params (eg. ["L1 L", "C1 C"]) to
+    minimize the sensitivity of tau to a pcnt percent change of any tuned
+    parameter across n_band frequencies in band = (f_min, f_max), without
+    letting the transmission (see transmission_load()) at the center of band
+    fall below min_transmission (default: its starting value).
+
+    The sensitivity is the relative change |dtau/tau|, so shrinking an
+    element towards nothing is not rewarded, and is aggregated over
+    parameters and frequencies by a smooth q-norm rather than the maximum
+    (see _design_objective()). The objective is weight*sensitivity -
+    transmission, plus a penalty that dominates it below min_transmission.
+    Once a design meets min_transmission, no step below it is accepted.
+
+    Parameters are searched on a log scale, so they stay positive, and are
+    kept within a factor of max_ratio of their starting values. Each
+    iteration takes the exact gradient of the objective (see
+    _design_gradient()) and evaluates a range of quasi-Newton (BFGS) step
+    lengths as one vectorized batch of designs. The network is not modified.
+
+    Returns an OptimizeResult, or None if a parameter is invalid.
+    """
+
+    cc = compile_circuit(network.circ)
+    if cc is None:
+        return None
+
+    targets = _tunable_targets(cc, params)
+    if targets is None:
+        return None
+
+    f0 = (band[0] + band[1])/2
+    fb = np.linspace(band[0], band[1], n_band)
+    n = len(targets)
+    lim = np.log(max_ratio)
+    steps = 2.0**-np.arange(-1, 20)
+    evaluations = 0
+
+    #q-norm order of the sensitivity aggregate and penalty weight per unit
+    #squared transmission shortfall
+    q = 8
+    mu = 1e6*max(1, weight)
+    if min_transmission is None:
+        min_transmission = float(transmission_load(_impedance(network.Z_l, f0), cc.Z_out(f0, _impedance(network.Z_s, f0))))
+    args = (f0, fb, weight, pcnt, min_transmission, q, mu)
+
+    def evaluate(X):
+        nonlocal evaluations
+        evaluations += len(X)
+        return _design_objective(network, cc, targets, X, *args)
+
+    def gradient(x):
+        return _design_gradient(network, cc, targets, x, *args)
+
+    x = np.zeros(n)
+    J, T = (v[0] for v in evaluate(x[np.newaxis])[:2])
+    g = gradient(x)
+    H = np.eye(n)
+
+    it = 0
+    while it < max_iter:
+        it += 1
+
+        #Line search over every step length at once, limiting each step to a
+        #factor of e in any parameter
+        d = -H @ g
+        if g @ d >= 0:
+            H = np.eye(n)
+            d = -g
+        scale = min(1, 1/np.max(np.abs(d))) if np.any(d) else 0
+        X = np.clip(x + np.outer(steps*scale, d), -lim, lim)
+        Jc, Tc = evaluate(X)[:2]
+        if T >= min_transmission:
+            Jc = np.where(Tc >= min_transmission, Jc, np.inf)
+        k = np.argmin(Jc)
+
+        if not Jc[k] < J - tol*max(1, abs(J)):
+            if np.array_equal(H, np.eye(n)):
+                break
+            H = np.eye(n)
+            continue
+
+        x_new = X[k]
+        g_new = gradient(x_new)
+        s = x_new - x
+        y = g_new - g
+        x, J, T, g = x_new, Jc[k], Tc[k], g_new
+
+        #BFGS update of the inverse Hessian
+        sy = s @ y
+        if sy > 1e-12:
+            I = np.eye(n)
+            H = (I - np.outer(s, y)/sy) @ H @ (I - np.outer(y, s)/sy) + np.outer(s, s)/sy
+
+    obj, T, smooth, peak = _design_objective(network, cc, targets, x[np.newaxis], *args)
+    R, L, C = _design_values(cc, targets, x[np.newaxis])
+
+    opt = CompiledCircuit(R[:, 0], L[:, 0], C[:, 0], cc.types, cc.series, cc.names)
+    net = Network(opt, network.Z_s, network.Z_l, network.freq)
+    net.V_in = network.V_in
+    values = {p: float(t[2]*np.exp(x[j])) for j, (p, t) in enumerate(zip(params, targets))}
+
+    return OptimizeResult(net, values, float(T[0]), float(peak[0]), float(obj[0]), it, evaluations)
+
+class MatchCandidate:
+    """ One matching network found by synthesize_match().
+
+    network      - Network with the solved ladder (its circ is a
+                   CompiledCircuit)
+    topology     - eg. "SER L, PAL C"
+    values       - element values, in ladder order
+    transmission - transmission_load() at the target frequency
+    peak_sens    - largest |dtau| for a pcnt percent change of any element,
+                   over the band
+    score        - weight*peak_sens - transmission (lower is better)
+    """
+
+    def __init__(self, network, topology:str, values:list, transmission:float, peak_sens:float, score:float):
+
+        self.network = network
+        self.topology = topology
+        self.values = values
+        self.transmission = transmission
+        self.peak_sens = peak_sens
+        self.score = score
+
+    def __str__(self):
+        return f"{self.topology}: transmission {self.transmission}, peak |dtau| {self.peak_sens}, values {self.values}"
+
+    def __repr__(self):
+        return self.__str__()
+
+def _ladder_topologies(depth:int):
+    """ Returns arrays (is_L, series) of shape (topologies, depth) holding
+    every lossless L/C ladder of that many elements. Adjacent elements
+    alternate between SER and PAL, since two SER (or two PAL) reactances in a
+    row act as one at a single frequency.
+    """
+
+    is_L = []
+    series = []
+    for first in (True, False):
+        for bits in range(2**depth):
+            is_L.append([(bits >> i) & 1 == 1 for i in range(depth)])
+            series.append([(i % 2 == 0) == first for i in range(depth)])
+
+    return (np.array(is_L, dtype=bool), np.array(series, dtype=bool))
+
+def _recip_box(box:tuple):
+    """ Returns the bounding box (g0, g1, b0, b1) of 1/Z over the box of
+    impedances (r0, r1, x0, x1), with r0 >= 0 and infinite ends allowed.
+    The same bounds map admittance boxes back to impedance.
+    """
+
+    r0, r1, x0, x1 = box
+    if r0 == 0 and x0 <= 0 <= x1:
+        return (0, math.inf, -math.inf, math.inf)
+
+    def recip(r, x):
+        if math.isinf(r) or math.isinf(x):
+            return (0.0, 0.0)
+        d = r*r + x*x
+        return (r/d, -x/d)
+
+    #1/Z is monotonic in R along lines of constant X except at R = |X|, and
+    #in X along lines of constant R except at X = 0 (for G) or X = +/-R (for B)
+    xs = [x0, x1] + [x for x in (0,) if x0 <= x <= x1]
+    points = []
+    for x in xs:
+        for r in (r0, r1, abs(x)):
+            if r0 <= r <= r1:
+                points.append((r, x))
+    for r in (r0, r1):
+        for x in (r, -r):
+            if x0 <= x <= x1 and not math.isinf(r):
+                points.append((r, x))
+
+    values = [recip(r, x) for r, x in points]
+    G = [v[0] for v in values]
+    B = [v[1] for v in values]
+
+    return (min(G), max(G), min(B), max(B))
+
+def _ladder_bound(is_L, series, Z_s:complex, Z_l:complex):
+    """ Returns an upper bound on the transmission each lossless ladder
+    topology can reach with any element values (see _ladder_topologies()).
+
+    A box holding every impedance the ladder can present is carried from
+    Z_s through the stages: a SER L (C) can only add positive (negative)
+    reactance, and a PAL L (C) only negative (positive) susceptance, so
+    each stage opens one side of the box. The bound is the largest
+    transmission_load() over the final box.
+    """
+
+    bound = np.empty(len(is_L))
+    Z_s = complex(Z_s)
+    R_l = complex(Z_l).real
+    X_l = complex(Z_l).imag
+    for t in range(len(is_L)):
+        r0 = r1 = Z_s.real
+        x0 = x1 = Z_s.imag
+        for l, ser in zip(is_L[t].tolist(), series[t].tolist()):
+            if ser:
+                if l:
+                    x1 = math.inf
+                else:
+                    x0 = -math.inf
+            else:
+                g0, g1, b0, b1 = _recip_box((r0, r1, x0, x1))
+                if l:
+                    b0 = -math.inf
+                else:
+                    b1 = math.inf
+                r0, r1, x0, x1 = _recip_box((g0, g1, b0, b1))
+
+        #Best reactance is the one nearest -X_l, then R = sqrt(R_l^2 + d^2)
+        d = max(x0 + X_l, -X_l - x1, 0)
+        R = min(max(math.sqrt(R_l*R_l + d*d), r0), r1)
+        bound[t] = 4*R_l*R/((R + R_l)**2 + d*d) if not math.isinf(R) else 0
+
+    return bound
+
+def _ladder_batch(is_L, series, X, freq, Z_s:complex):
+    """ Evaluates a batch of lossless L/C ladders with element values exp(X),
+    where is_L, series and X are (designs, depth) arrays. freq is a float or
+    1D array.
+
+    Returns (Zout, dZ): Zout is shaped (designs, *freq) and dZ (designs,
+    depth, *freq) holds d(Zout)/d(X), carried forward through the ladder.
+    """
+
+    f = np.atleast_1d(np.asarray(freq, dtype=float))
+    w = 2*3.14159*f
+    B, depth = X.shape
+    v = np.exp(X)[..., np.newaxis]
+
+    Z = np.full((B, len(f)), Z_s, dtype=complex)
+    dZ = np.zeros((B, depth, len(f)), dtype=complex)
+    for i in range(depth):
+        L_i = is_L[:, i, np.newaxis]
+        ser = series[:, i, np.newaxis]
+        Ze = np.where(L_i, complex(0, 1)*w*v[:, i], complex(0, -1)/(w*v[:, i]))
+        dZe = np.where(L_i, Ze, -Ze)
+
+        S = Z + Ze
+        a = np.where(ser, 1, (Ze/S)**2)
+        b = np.where(ser, 1, (Z/S)**2)
+        Z = np.where(ser, Z + Ze, Z*Ze/S)
+        dZ = dZ*a[:, np.newaxis]
+        dZ[:, i] += b*dZe
+
+    if np.ndim(freq) == 0:
+        return (Z[:, 0], dZ[..., 0])
+
+    return (Z, dZ)
+
+def _solve_ladders(is_L, series, X, f0:float, Z_s:complex, Z_l:complex, target:float, max_iter:int):
+    """ Solves a batch of ladders for Zout = conj(Z_l) at f0 by Gauss-Newton
+    from the starting values X. Designs that stall short of the target
+    transmission are dropped as they go.
+
+    Returns the surviving (is_L, series, X, transmission).
+    """
+
+    goal = np.conj(Z_l)
+    best = np.full(len(X), -np.inf)
+    for it in range(max_iter):
+        Z, dZ = _ladder_batch(is_L, series, X, f0, Z_s)
+        T = transmission_load(Z_l, Z)
+
+        #Every 10 iterations, drop designs that have stopped improving
+        if it % 10 == 9:
+            keep = (T >= target) | (T > best + 1e-4)
+            is_L, series, X, Z, dZ, T = is_L[keep], series[keep], X[keep], Z[keep], dZ[keep], T[keep]
+            best = T.copy()
+        if len(X) == 0 or np.all(T >= 1 - 1e-12):
+            break
+
+        r = Z - goal
+        J = np.concatenate((dZ.real[:, np.newaxis], dZ.imag[:, np.newaxis]), axis=1)
+        step = -np.einsum("bkr,br->bk", np.linalg.pinv(J), np.stack((r.real, r.imag), axis=1))
+
+        #Limit each step to a factor of e in any element
+        step = step/np.maximum(1, np.max(np.abs(step), axis=1, keepdims=True))
+        X = X + step
+
+    T = transmission_load(Z_l, _ladder_batch(is_L, series, X, f0, Z_s)[0])
+    ok = np.isfinite(T) & (T >= target)
+
+    return (is_L[ok], series[ok], X[ok], T[ok])
+
+def synthesize_match(Z_s:complex, Z_l:complex, f0:float, max_depth:int=3, band:tuple=None, target:float=0.99, n_starts:int=64, weight:float=1, pcnt:float=1, n_keep:int=10, out_dir:str=None, max_iter:int=60, seed=None):
+    """ Searches lossless L/C ladders of 1 to max_depth elements for networks
+    matching Z_l to Z_s at f0 (eg. depth 2 covers the L networks, 3 the Pi
+    and T networks).
+
+    For each depth, topologies that cannot reach the target transmission
+    with any element values (by the bound of _ladder_bound()) are skipped.
+    Every other topology (see _ladder_topologies()) is solved from n_starts
+    random starting values at once, by batched Gauss-Newton on
+    Zout = conj(Z_l), and designs that stall below the target are dropped.
+    Survivors are ranked by weight*peak_sens - transmission, where peak_sens
+    is the largest |dtau| for a pcnt percent change of any element across
+    band (default f0 +/- 5%).
+
+    Returns a list of up to n_keep MatchCandidates, the best design of each
+    topology, best first. If out_dir is
+    given, each is also written there as match_<rank>.mc (see
+    save_circuit()).
+    """
+
+    rng = np.random.default_rng(seed)
+    if band is None:
+        band = (0.95*f0, 1.05*f0)
+    fb = np.linspace(band[0], band[1], 21)
+
+    #Reference element values for an impedance between Z_s and Z_l
+    w0 = 2*3.14159*f0
+    Z_ref = np.sqrt(abs(Z_s)*abs(Z_l))
+    L_ref = np.log(Z_ref/w0)
+    C_ref = np.log(1/(w0*Z_ref))
+
+    found = []
+    for depth in range(1, max_depth + 1):
+        is_L, series = _ladder_topologies(depth)
+        reach = np.repeat(_ladder_bound(is_L, series, Z_s, Z_l) >= target, n_starts)
+        is_L = np.repeat(is_L, n_starts, axis=0)
+        series = np.repeat(series, n_starts, axis=0)
+        X = np.where(is_L, L_ref, C_ref) + rng.uniform(-np.log(10), np.log(10), is_L.shape)
+
+        #Skip topologies that cannot reach the target with any values
+        is_L, series, X = is_L[reach], series[reach], X[reach]
+        if len(X) == 0:
+            continue
+
+        is_L, series, X, T = _solve_ladders(is_L, series, X, f0, Z_s, Z_l, target, max_iter)
+        if len(X) == 0:
+            continue
+
+        #Band sensitivity of every surviving design at once
+        Z, dZ = _ladder_batch(is_L, series, X, fb, Z_s)
+        S = Z_l + Z
+        dT_dZ = 4*Z_l*(Z_l - Z)/(S*S*S)
+        peak = np.max(np.abs(dT_dZ[:, np.newaxis]*dZ), axis=(1, 2))*pcnt/100.0
+
+        for b in range(len(X)):
+            found.append((weight*peak[b] - T[b], depth, is_L[b], series[b], X[b], T[b], peak[b]))
+
+    #Rank, keeping the best solution of each topology
+    found.sort(key=lambda c: (c[0], c[1]))
+    results = []
+    seen = set()
+    for score, depth, L_b, ser_b, X_b, T_b, peak_b in found:
+        key = (L_b.tobytes(), ser_b.tobytes())
+        if key in seen:
+            continue
+        seen.add(key)
+        results.append((L_b, ser_b, X_b, T_b, peak_b, score))
+        if len(results) == n_keep:
+            break
+
+    candidates = []
+    for rank, (L_b, ser_b, X_b, T_b, peak_b, score) in enumerate(results):
+        vals = np.exp(X_b)
+        names = []
+        for i, l in enumerate(L_b):
+            kind = "L" if l else "C"
+            names.append(f"{kind}{i+1}")
+        cc = CompiledCircuit(np.zeros(len(vals)), np.where(L_b, vals, 0), np.where(L_b, 0, vals), np.where(L_b, Passive.L.value, Passive.C.value), ser_b, names)
+        net = Network(cc, Z_s, Z_l, f0)
+        topology = ", ".join(f"{'SER' if s else 'PAL'} {n[0]}" for s, n in zip(ser_b, names))
+
+        candidates.append(MatchCandidate(net, topology, vals.tolist(), float(T_b), float(peak_b), float(score)))
+
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+            save_circuit(cc, os.path.join(out_dir, f"match_{rank}.mc"), f"{topology}\nZ_s = {Z_s}, Z_l = {Z_l}, f0 = {f0} Hz\ntransmission {T_b}, peak |dtau| {peak_b}")
+
+    return candidates
+
+def _json_complex(z):
+    """ Returns z as a [real, imag] list for JSON. A TabulatedImpedance is
+    recorded by its name.
+    """
+
+    if isinstance(z, TabulatedImpedance):
+        return {"table": z.name, "points": len(z)}
+
+    z = complex(z)
+    return [z.real, z.imag]
+
+class ResultWriter:
+    """ Writes results straight into a preallocated memory mapped .npy file,
+    so outputs larger than RAM can be built a chunk at a time. Chunks are
+    appended along the first axis (eg. draws for Monte Carlo, frequencies for
+    a sweep).
+
+    Alongside filename, a JSON sidecar (same name, .json extension) records
+    the shape, dtype, rows written so far, network (circuit, Z_s, Z_l, V_in),
+    params and any extra metadata. If freqs is given it is saved as
+    <name>.freqs.npy. Read the results back with open_results().
+
+    eg.
+        with ResultWriter("mc.npy", (100000, len(fs), 2), net, freqs=fs) as w:
+            monte_carlo(net, tols, 100000, fs, sink=w.append)
+    """
+
+    def __init__(self, filename:str, shape:tuple, network=None, dtype=complex, freqs=None, params:list=None, metadata:dict=None):
+
+        self.filename = filename
+        self.base = os.path.splitext(filename)[0]
+        self.array = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=tuple(shape))
+        self.rows = 0
+
+        self.meta = {"file": os.path.basename(filename), "shape": list(self.array.shape), "dtype": self.array.dtype.str, "rows": 0}
+
+        if network is not None:
+            cc = compile_circuit(network.circ)
+            if cc is not None:
+                self.meta["circuit"] = [{"name": cc.names[i], "type": Passive(int(cc.types[i])).name, "orientation": "SER" if cc.series[i] else "PAL", "R": float(cc.R[i]), "L": float(cc.L[i]), "C": float(cc.C[i])} for i in range(len(cc))]
+            self.meta["Z_s"] = _json_complex(network.Z_s)
+            self.meta["Z_l"] = _json_complex(network.Z_l)
+            self.meta["V_in"] = float(network.V_in)
+
+        if freqs is not None:
+            freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+            np.save(self.base + ".freqs.npy", freqs)
+            self.meta["freqs"] = os.path.basename(self.base + ".freqs.npy")
+            self.meta["f_min"] = float(freqs.min())
+            self.meta["f_max"] = float(freqs.max())
+            self.meta["n_freqs"] = len(freqs)
+
+        if params is not None:
+            self.meta["params"] = list(params)
+        if metadata is not None:
+            self.meta.update(metadata)
+
+        self._write_meta()
+
+    def __str__(self):
+        return f"ResultWriter({self.filename}): {self.rows}/{self.array.shape[0]} rows"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _write_meta(self):
+        """ Writes the JSON sidecar. It is written to a temporary file and
+        renamed over the old one, so it is never left half written.
+        """
+
+        self.meta["rows"] = self.rows
+        with open(self.base + ".json.tmp", "w") as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(self.base + ".json.tmp", self.base + ".json")
+
+    def append(self, *chunks):
+        """ Writes a chunk of rows after those already written. If several
+        arrays are given they are stacked along a new last axis, so
+        append(tau, P) stores tau and P side by side.
+
+        The sidecar row count is updated after every chunk, so the results
+        of a run that stops part way can still be read with open_results().
+        Raises ValueError if the chunk would overrun the file, so a sink
+        passed to monte_carlo() stops the run instead of dropping rows.
+        """
+
+        chunk = chunks[0] if len(chunks) == 1 else np.stack(chunks, axis=-1)
+        n = len(chunk)
+        if self.rows + n > self.array.shape[0]:
+            raise ValueError(f"Writing {n} rows would overrun the {self.array.shape[0]} rows of {self.filename} ({self.rows} written)")
+
+        self.array[self.rows:self.rows+n] = chunk
+        self.rows += n
+        self._write_meta()
+
+    def flush(self):
+        """ Flushes written rows to disk and updates the sidecar """
+
+        self.array.flush()
+        self._write_meta()
+
+    def close(self):
+        """ Flushes and releases the memory map """
+
+        self.flush()
+        self.array = None
+
+def open_results(filename:str):
+    """ Opens results written by a ResultWriter without loading them. Returns
+    a tuple (array, meta): array is a read only memory map of the rows
+    written and meta the sidecar dictionary, with "freqs" replaced by a
+    memory map of the frequencies if they were saved.
+    """
+
+    base = os.path.splitext(filename)[0]
+    with open(base + ".json") as f:
+        meta = json.load(f)
+
+    if "freqs" in meta:
+        meta["freqs"] = np.load(os.path.join(os.path.dirname(filename), meta["freqs"]), mmap_mode='r')
+
+    return (np.load(filename, mmap_mode='r')[:meta["rows"]], meta)
+
+def write_spectrum(filename:str, network, params:list, fs, spectrum=get_spectrum_pcnt, chunk_size:int=65536, **kwargs):
+    """ Evaluates spectrum (one of the get_spectrum_*() functions) for every
+    parameter in params over fs, chunk by chunk (see spectrum_chunks()),
+    writing a (len(fs), len(params)) array to filename with a ResultWriter.
+    Returns the filename.
+    """
+
+    fs = np.asarray(fs, dtype=float)
+    with ResultWriter(filename, (len(fs), len(params)), network, float, fs, params) as w:
+        for f, v in spectrum_chunks(network, params, fs, spectrum, chunk_size, **kwargs):
+            w.append(v.T)
+
+    return filename
+
+def _hash_update(h, obj, net_freq:bool=True):
+    """ Feeds obj into the hashlib object h. Networks are hashed by their
+    compiled values rather than by identity, and without their freq if
+    net_freq is False. Functions are hashed by name and bytecode, so the
+    hash is the same in every process.
+    """
+
+    if isinstance(obj, Network):
+        h.update(b"Network")
+        cc = compile_circuit(obj.circ)
+        _hash_update(h, (cc, obj.Z_s, obj.Z_l, obj.V_in, obj.freq if net_freq else None), net_freq)
+    elif isinstance(obj, TabulatedImpedance):
+        h.update(b"TabulatedImpedance")
+        _hash_update(h, (obj.freqs, obj.Z))
+    elif isinstance(obj, CompiledCircuit):
+        h.update(b"CompiledCircuit")
+        _hash_update(h, (obj.R, obj.L, obj.C, obj.types, obj.series, obj.names))
+    elif isinstance(obj, np.ndarray) or isinstance(obj, np.number):
+        a = np.ascontiguousarray(obj)
+        h.update(f"ndarray{a.dtype.str}{a.shape}".encode())
+        h.update(a.tobytes())
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"(")
+        for x in obj:
+            _hash_update(h, x, net_freq)
+            h.update(b",")
+        h.update(b")")
+    elif isinstance(obj, dict):
+        h.update(b"{")
+        for k in sorted(obj, key=repr):
+            _hash_update(h, k, net_freq)
+            h.update(b":")
+            _hash_update(h, obj[k], net_freq)
+            h.update(b",")
+        h.update(b"}")
+    elif callable(obj) and hasattr(obj, "__qualname__"):
+        h.update(f"callable:{getattr(obj, '__module__', None)}.{obj.__qualname__}".encode())
+        code = getattr(obj, "__code__", None)
+        if code is not None:
+            h.update(code.co_code)
+    elif isinstance(obj, (str, bytes, int, float, complex, bool, type(None), Enum)):
+        h.update(f"{type(obj).__name__}:{obj!r}".encode())
+    elif hasattr(obj, "__dict__"):
+        #The default repr of other objects holds their address, so use their fields
+        h.update(f"{type(obj).__module__}.{type(obj).__qualname__}".encode())
+        _hash_update(h, vars(obj), net_freq)
+    else:
+        h.update(f"{type(obj).__name__}:{obj!r}".encode())
+
+_source_salt = None
+
+def _cache_salt():
+    """ Returns a hash of this module's source and the numpy version, so
+    ResultCache entries are not reused after either changes.
+    """
+
+    global _source_salt
+    if _source_salt is None:
+        h = hashlib.sha256()
+        try:
+            with open(__file__, "rb") as f:
+                h.update(f.read())
+        except OSError:
+            pass
+        h.update(np.__version__.encode())
+        _source_salt = h.hexdigest()
+
+    return _source_salt
+
+def _pack_result(result, arrays:list):
+    """ Describes the structure of a result as JSON, moving its arrays into
+    the list arrays. Returns the description, or None if the result holds
+    something that cannot be stored.
+    """
+
+    if isinstance(result, np.ndarray):
+        arrays.append(result)
+        return {"array": len(arrays) - 1}
+    elif isinstance(result, np.generic):
+        arrays.append(np.asarray(result))
+        return {"scalar": len(arrays) - 1}
+    elif isinstance(result, (tuple, list)):
+        items = [_pack_result(x, arrays) for x in result]
+        if any(x is None for x in items):
+            return None
+        return {type(result).__name__: items}
+    elif isinstance(result, complex):
+        return {"complex": [result.real, result.imag]}
+    elif result is None or isinstance(result, (bool, int, float, str)):
+        return {"value": result}
+
+    return None
+
+def _unpack_result(desc, arrays:list):
+    """ Rebuilds a result described by _pack_result() """
+
+    if "array" in desc:
+        return arrays[desc["array"]]
+    elif "scalar" in desc:
+        return arrays[desc["scalar"]][()]
+    elif "tuple" in desc:
+        return tuple(_unpack_result(x, arrays) for x in desc["tuple"])
+    elif "list" in desc:
+        return [_unpack_result(x, arrays) for x in desc["list"]]
+    elif "complex" in desc:
+        return complex(*desc["complex"])
+
+    return desc["value"]
+
+class ResultCache:
+    """ Persistent on-disk cache of sweep results. Results are stored as .npy
+    files in directory with a .json sidecar describing their structure,
+    named by a sha256 hash of the function, all of its arguments and this
+    module's source (see key()). Networks are hashed by their compiled
+    circuit values, Z_s, Z_l, V_in and freq, so editing or reloading a .mc
+    file with the same contents still hits the cache.
+
+    Cached arrays are returned memory mapped and read only. When the files
+    exceed max_bytes, the least recently used results are deleted.
+
+    eg.
+        cache = ResultCache("sweep_cache")
+        spec = cache.call(get_spectrum_pcnt, net, "L1 L", fs)
+    """
+
+    def __init__(self, directory:str, max_bytes:int=256*1024**2):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def __str__(self):
+        return f"ResultCache({self.directory}): {self.hits} hits, {self.misses} misses, {self.size()} bytes"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def key(self, func, *args, **kwargs):
+        """ Returns the hash used to store func(*args, **kwargs). Arguments
+        are bound to func's signature with defaults filled in, so f(x) and
+        f(x, default) share a key. If a frequency argument (fs, freqs or
+        freq) is given, the freq of any Network argument is not hashed,
+        since it is replaced. The source of this module is part of the key.
+        """
+
+        try:
+            bound = inspect.signature(func).bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+        except (TypeError, ValueError):
+            arguments = {"args": args, "kwargs": kwargs}
+        net_freq = all(arguments.get(f) is None for f in ("fs", "freqs", "freq"))
+
+        h = hashlib.sha256()
+        _hash_update(h, _cache_salt())
+        _hash_update(h, func)
+        _hash_update(h, arguments, net_freq)
+
+        return h.hexdigest()
+
+    def _files(self):
+        """ Returns a dict mapping each stored key to its list of files """
+
+        files = {}
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy") or name.endswith(".json"):
+                files.setdefault(name.split(".")[0], []).append(os.path.join(self.directory, name))
+
+        return files
+
+    def size(self):
+        """ Returns the total size of the stored results in bytes """
+
+        return sum(os.path.getsize(f) for fs in self._files().values() for f in fs)
+
+    def get(self, key:str):
+        """ Returns the stored result for key, or None if there is none. The
+        result has the same structure as when it was stored (eg. a tuple of
+        a list of names and arrays), with arrays memory mapped.
+        """
+
+        path = os.path.join(self.directory, key + ".json")
+        try:
+            with open(path) as f:
+                meta = json.load(f)
+            os.utime(path)
+            arrays = []
+            for i in range(meta["arrays"]):
+                arrays.append(np.load(os.path.join(self.directory, f"{key}.{i}.npy"), mmap_mode='r'))
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return _unpack_result(meta["result"], arrays)
+
+    def _save(self, path:str, data:bytes=None, arr=None):
+        """ Writes data (or the array arr) to path atomically """
+
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            if arr is not None:
+                np.save(f, np.asarray(arr))
+            else:
+                f.write(data)
+        os.replace(tmp, path)
+
+    def put(self, key:str, result):
+        """ Stores result (numpy arrays, possibly in tuples or lists with
+        numbers and strings) under key, then evicts old results if the cache
+        is over size. Returns False if the result cannot be stored.
+        """
+
+        arrays = []
+        desc = _pack_result(result, arrays)
+        if desc is None:
+            return False
+
+        for i, arr in enumerate(arrays):
+            self._save(os.path.join(self.directory, f"{key}.{i}.npy"), arr=arr)
+
+        #The sidecar is written last, so a result is only seen once complete
+        meta = {"arrays": len(arrays), "result": desc}
+        self._save(os.path.join(self.directory, key + ".json"), json.dumps(meta).encode())
+
+        self.evict()
+        return True
+
+    def evict(self):
+        """ Deletes the least recently used results until the cache is no
+        larger than max_bytes.
+        """
+
+        entries = []
+        total = 0
+        for key, fs in self._files().items():
+            size = sum(os.path.getsize(f) for f in fs)
+            entries.append((max(os.path.getmtime(f) for f in fs), size, fs))
+            total += size
+
+        entries.sort(key=lambda e: e[0])
+        for mtime, size, fs in entries:
+            if total <= self.max_bytes:
+                break
+            for f in fs:
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+            total -= size
+
+    def clear(self):
+        """ Deletes every stored result """
+
+        for fs in self._files().values():
+            for f in fs:
+                os.remove(f)
+
+    def call(self, func, *args, **kwargs):
+        """ Returns func(*args, **kwargs), from the cache if it has been
+        stored before. Intended for the get_spectrum_*() functions,
+        sensitivity_matrix() and gradient_net(), or anything else returning
+        numpy arrays, possibly in tuples or lists.
+        """
+
+        key = self.key(func, *args, **kwargs)
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = func(*args, **kwargs)
+        if result is not None:
+            self.put(key, result)
+
+        return result
@@ -0,0 +1,245 @@
+""" Benchmarks the main MNSensitivity functions on simple.mc, low_pass.mc and
+synthetic ladders of 2 to 1000 elements, across several frequency counts.
+
+Reports per-call latency, points/second and peak memory for each case as
+JSON, so results from different versions can be compared. Every case is
+timed with the circuit lists load_circuit() returns ("list" input), and
+again with compiled circuits where the module has compile_circuit()
+("compiled" input). The core cases only use calls every version has, so
+--module can point at an older copy of MNSensitivity.py for a before and
+after comparison. Cases that are too large or that the module does not
+support are listed under "skipped".
+
+    python benchmark.py                  # full suite, JSON to stdout
+    python benchmark.py --quick -o a.json
+    git show <rev>:MNSensitivity.py > /tmp/old/MNSensitivity.py
+    python benchmark.py --quick --module /tmp/old/MNSensitivity.py -o b.json
+"""
+
+import numpy as np
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+#Module being benchmarked, set in main()
+M = None
+
+def load_module(path:str=None):
+    """ Imports MNSensitivity, from path if given """
+
+    if path is None:
+        import MNSensitivity
+        return MNSensitivity
+
+    spec = importlib.util.spec_from_file_location("MNSensitivity", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["MNSensitivity"] = module
+    spec.loader.exec_module(module)
+    return module
+
+def synthetic_ladder(n:int, seed:int=0):
+    """ Returns a circuit list of n elements alternating SER inductors and PAL
+    capacitors around the low_pass.mc values, with small parasitics. The
+    same n and seed always give the same circuit.
+    """
+
+    rng = np.random.default_rng(seed + n)
+    circ = []
+    for i in range(n):
+        if i % 2 == 0:
+            comp = M.Component(f"L{i} L L {8.9e-9*rng.uniform(.5, 2)} R {rng.uniform(0, .5)} C {rng.uniform(0, 2e-13)}")
+            circ.append((comp, "SER"))
+        else:
+            comp = M.Component(f"C{i} C C {10.1e-12*rng.uniform(.5, 2)} R {rng.uniform(0, .1)} L {rng.uniform(0, 1e-10)}")
+            circ.append((comp, "PAL"))
+
+    return circ
+
+def time_call(func, min_time:float, repeats:int):
+    """ Returns the best per-call time of func over repeats runs, each of
+    enough calls to take at least min_time.
+    """
+
+    func()
+    calls = 1
+    while True:
+        t0 = time.perf_counter()
+        for i in range(calls):
+            func()
+        t = time.perf_counter() - t0
+        if t >= min_time:
+            break
+        calls *= 2 if t == 0 else max(2, int(min_time/t) + 1)
+
+    best = t/calls
+    for r in range(repeats - 1):
+        t0 = time.perf_counter()
+        for i in range(calls):
+            func()
+        best = min(best, (time.perf_counter() - t0)/calls)
+
+    return (best, calls)
+
+def peak_memory(func):
+    """ Returns the peak memory allocated by one call of func in bytes """
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak
+
+def supports_arrays(circ):
+    """ Returns True if the module evaluates frequency arrays in one call """
+
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            Z = M.Z_out(circ, np.array([1e8, 2e8]), complex(50, 0))
+        return np.shape(Z) == (2,)
+    except Exception:
+        return False
+
+def cases(circ, param:str, fs, arrays:bool):
+    """ Returns (name, function) pairs for every benchmarked call at the
+    frequencies fs, and a list of (name, reason) for calls left out. circ
+    is a circuit list or a CompiledCircuit.
+
+    The spectra take fs in every version. The single point calls are timed
+    at one frequency, or over the whole of fs if the module supports
+    frequency arrays (arrays).
+    """
+
+    skipped = []
+    out = []
+    if len(fs) == 1 or arrays:
+        freq = fs[0] if len(fs) == 1 else fs
+        net = M.Network(circ, 50, complex(20, 30), freq)
+        out += [
+            ("Z_out", lambda: M.Z_out(circ, freq, complex(50, 0))),
+            ("tau_net", lambda: M.tau_net(net)),
+            ("P_net", lambda: M.P_net(net)),
+            ("sensitivity", lambda: M.sensitivity(net, param, 1e-12, use_tau=True)),
+            ("sens_pcnt", lambda: M.sens_pcnt(net, param)),
+        ]
+    else:
+        for name in ("Z_out", "tau_net", "P_net", "sensitivity", "sens_pcnt"):
+            skipped.append((name, "frequency arrays not supported"))
+
+    net = M.Network(circ, 50, complex(20, 30), fs[0])
+    out += [
+        ("get_spectrum_pcnt", lambda: M.get_spectrum_pcnt(net, param, fs)),
+        ("get_spectrum_val", lambda: M.get_spectrum_val(net, param, fs, 1e-12)),
+        ("get_spectrum_norm", lambda: M.get_spectrum_norm(net, param, fs)),
+    ]
+
+    return (out, skipped)
+
+def git_revision():
+    """ Returns the current git commit, or None outside a git checkout """
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+
+    global M
+
+    parser = argparse.ArgumentParser(description="Benchmark MNSensitivity")
+    parser.add_argument("-o", "--output", help="write JSON here instead of stdout")
+    parser.add_argument("--module", help="path of the MNSensitivity.py to benchmark (default: the importable one)")
+    parser.add_argument("--quick", action="store_true", help="fewer sizes and shorter timing runs")
+    parser.add_argument("--min-time", type=float, default=.2, help="minimum seconds per timing run")
+    parser.add_argument("--repeats", type=int, default=3, help="timing runs per case (best is reported)")
+    parser.add_argument("--max-work", type=float, default=2e6, help="skip cases of more elements x frequencies than this")
+    args = parser.parse_args()
+
+    if args.quick:
+        sizes = [2, 10, 100]
+        n_freqs = [1, 100]
+        args.min_time = min(args.min_time, .05)
+    else:
+        sizes = [2, 10, 100, 1000]
+        n_freqs = [1, 100, 10000]
+
+    #Anything the module prints (eg. warnings about zero capacitance) goes
+    #to stderr while loading and is discarded while timing, so stdout only
+    #ever holds the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        M = load_module(args.module)
+        circuits = [("simple.mc", M.load_circuit("simple.mc"), "L1 L"), ("low_pass.mc", M.load_circuit("low_pass.mc"), "L1 L")]
+        for n in sizes:
+            circuits.append((f"ladder_{n}", synthetic_ladder(n), "L0 L"))
+
+        inputs = []
+        for circ_name, circ, param in circuits:
+            inputs.append((circ_name, "list", circ, param))
+            if hasattr(M, "compile_circuit"):
+                inputs.append((circ_name, "compiled", M.compile_circuit(circ), param))
+
+    arrays = supports_arrays(circuits[0][1])
+
+    results = []
+    skipped = []
+    devnull = open(os.devnull, "w")
+    for circ_name, kind, circ, param in inputs:
+        for nf in n_freqs:
+
+            base = {"circuit": circ_name, "input": kind, "n_elements": len(circ), "n_freqs": nf}
+            if len(circ)*nf > args.max_work:
+                skipped.append({**base, "function": "*", "reason": f"more than --max-work={args.max_work:g} element evaluations"})
+                continue
+
+            fs = np.logspace(6, 10, nf)
+            funcs, left_out = cases(circ, param, fs, arrays)
+            for name, reason in left_out:
+                skipped.append({**base, "function": name, "reason": reason})
+
+            for name, func in funcs:
+                with contextlib.redirect_stdout(devnull):
+                    latency, calls = time_call(func, args.min_time, args.repeats)
+                    peak = peak_memory(func)
+                results.append({
+                    "function": name,
+                    **base,
+                    "calls": calls,
+                    "latency_s": latency,
+                    "points_per_s": nf/latency,
+                    "peak_bytes": peak,
+                })
+                print(f"{name:18s} {circ_name:12s} {kind:8s} f={nf:<6d} {latency*1e6:12.1f} us", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git": git_revision(),
+            "module": os.path.abspath(M.__file__),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "min_time": args.min_time,
+            "repeats": args.repeats,
+            "frequency_arrays": arrays,
+        },
+        "results": results,
+        "skipped": skipped,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+
+if __name__ == "__main__":
+    main()